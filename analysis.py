@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+Statistics of regions and paths drawn on the map.
+"""
+
+import numpy as np
+
+
+def unwrap_longitudes(lons):
+	"Remove jumps at the antimeridian, so that a path crossing it stays continuous."
+	lons = np.asarray(lons, dtype=np.float64)
+	steps = (np.diff(lons) + 180) % 360 - 180
+	return np.concatenate([lons[:1], lons[0] + np.cumsum(steps)])
+
+
+def ground_distances(lons, lats, radius=6371.0):
+	"Great circle distance in km between consecutive points (haversine)."
+	lons = np.radians(lons)
+	lats = np.radians(lats)
+	dlon = np.diff(lons)
+	dlat = np.diff(lats)
+	a = np.sin(dlat / 2) ** 2 + np.cos(lats[:-1]) * np.cos(lats[1:]) * np.sin(dlon / 2) ** 2
+	return 2 * radius * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def resample_path(lons, lats, samples):
+	"Points at uniform ground distance along the path. Returns distances from the start (km), longitudes and latitudes."
+	lons = unwrap_longitudes(lons)
+	lats = np.asarray(lats, dtype=np.float64)
+	along = np.concatenate([[0], np.cumsum(ground_distances(lons, lats))])
+	distances = np.linspace(0, along[-1], samples)
+	return distances, (np.interp(distances, along, lons) + 180) % 360 - 180, np.interp(distances, along, lats)
+
+
+def elevation_profile(dem, lons, lats, samples=512):
+	"Distances (km) and elevations (m) along the path, sampled with bilinear interpolation."
+	distances, lons, lats = resample_path(lons, lats, samples)
+	return distances, dem.sample_bilinear(lons, lats)
+
+
+def polygon_mask(lons, lats, polygon_lons, polygon_lats):
+	"Points inside the polygon (even-odd rule). Loops over polygon edges, every edge is tested against all points at once."
+	inside = np.zeros(np.broadcast(lons, lats).shape, dtype=bool)
+	x0 = np.asarray(polygon_lons)
+	y0 = np.asarray(polygon_lats)
+	x1 = np.roll(x0, -1)
+	y1 = np.roll(y0, -1)
+	for xa, ya, xb, yb in zip(x0, y0, x1, y1):
+		if ya == yb:
+			continue
+		crosses = (ya > lats) != (yb > lats)
+		x_cross = xa + (lats - ya) * (xb - xa) / (yb - ya)
+		inside ^= crosses & (lons < x_cross)
+	return inside
+
+
+def region_composition(cube, polygon_lons, polygon_lats):
+	"""
+	Area-weighted fraction of every biome class inside the polygon, for all epochs at once.
+	Cells are weighted by cosine of latitude, cells without data are left out.
+	Returns years and array epochs x classes.
+	"""
+	
+	polygon_lons = unwrap_longitudes(polygon_lons)
+	polygon_lats = np.asarray(polygon_lats, dtype=np.float64)
+	cpd = cube.cells_per_degree
+	
+	r0 = max(int(np.floor((90 - polygon_lats.max()) * cpd)), 0)
+	r1 = min(int(np.ceil((90 - polygon_lats.min()) * cpd)), cube.rows)
+	c0 = int(np.floor((polygon_lons.min() + 180) * cpd))
+	c1 = int(np.ceil((polygon_lons.max() + 180) * cpd))
+	classes_count = len(cube.palette)
+	if r0 >= r1 or c0 >= c1:
+		return cube.years, np.zeros((cube.epochs, classes_count))
+	
+	rows = np.arange(r0, r1)
+	cols = np.arange(c0, c1)
+	cell_lats = 90 - (rows[:, None] + 0.5) / cpd
+	cell_lons = (cols[None, :] + 0.5) / cpd - 180
+	mask = polygon_mask(cell_lons, cell_lats, polygon_lons, polygon_lats)
+	weights = np.broadcast_to(np.cos(np.radians(cell_lats)), mask.shape)[mask]
+	
+	classes = cube.array[:, r0:r1][:, :, cols % cube.cols][:, mask].astype(np.intp) # epochs x cells
+	classes[classes >= classes_count] = classes_count # no data goes to an extra bin
+	
+	bins = classes + (classes_count + 1) * np.arange(cube.epochs)[:, None]
+	sums = np.bincount(bins.ravel(), weights=np.broadcast_to(weights, classes.shape).ravel(), minlength=cube.epochs * (classes_count + 1))
+	sums = sums.reshape(cube.epochs, classes_count + 1)[:, :classes_count]
+	totals = sums.sum(axis=1, keepdims=True)
+	return cube.years, sums / np.where(totals > 0, totals, 1)
+
+
+def format_composition(years, fractions, names, threshold=0.01):
+	"Text table of the composition, one row per epoch. Only classes reaching `threshold` in some epoch are shown."
+	shown = [_n for _n in range(fractions.shape[1]) if fractions[:, _n].max() >= threshold]
+	lines = ["year\t" + "\t".join(names[_n] for _n in shown)]
+	for year, row in zip(years, fractions):
+		lines.append(f"{year}\t" + "\t".join(f"{row[_n]:.3f}" for _n in shown))
+	return "\n".join(lines)
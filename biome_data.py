@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+Biome classes of all epochs, as written by `generate_biome_maps.py`.
+"""
+
+import json
+import numpy as np
+from pathlib import Path
+
+
+class BiomeCube:
+	"Memory-mapped uint8 array time x lat x lon of class indices. Rows go from north to south, columns from 180W eastwards."
+	
+	def __init__(self, directory='biome'):
+		index = json.loads(Path(directory, 'index.json').read_text())
+		self.filename = str(Path(directory, 'biome.npy'))
+		self.array = np.load(self.filename, mmap_mode='r')
+		self.years = index['years']
+		self.palette = index['palette']
+		self.nodata = index['nodata']
+		self.names = index.get('names', [f"Biome {_n}" for _n in range(len(self.palette))])
+		self.epochs, self.rows, self.cols = self.array.shape
+		self.cells_per_degree = self.cols / 360
+	
+	def epoch_index(self, year):
+		return self.years.index(year)
+	
+	def classes(self, year):
+		"Class grid of one epoch. A view, nothing is read until used."
+		return self.array[self.epoch_index(year)]
+	
+	def cell_index(self, lons, lats):
+		"Row and column of the cells containing the points. Works on scalars and arrays."
+		rows = np.clip(np.floor((90 - lats) * self.cells_per_degree).astype(np.intp), 0, self.rows - 1)
+		cols = np.floor((lons + 180) * self.cells_per_degree).astype(np.intp) % self.cols
+		return rows, cols
+	
+	def sample(self, lons, lats, year):
+		"Class indices at the points."
+		rows, cols = self.cell_index(lons, lats)
+		return self.array[self.epoch_index(year), rows, cols]
+	
+	def name(self, n):
+		if n == self.nodata or n >= len(self.names):
+			return None
+		return self.names[n]
+	
+	def argb_lut(self, alpha=1):
+		"Lookup table from class index to premultiplied ARGB32 pixel. No data is transparent."
+		lut = np.zeros(256, dtype=np.uint32)
+		a = round(alpha * 255)
+		for n, (r, g, b) in enumerate(self.palette):
+			if n == self.nodata:
+				continue
+			lut[n] = (a << 24) | (round(r * a) << 16) | (round(g * a) << 8) | round(b * a)
+		return lut
+
+
+class BiomeTiles:
+	"""
+	Biome classes of every map tile as rectangles of one class, as written by `generate_biome_maps.py`. File `tiles/{year}.npz` per epoch.
+	For every simplification factor `f` (majority class of f x f cells), array `L{f}` of rectangles (class, column, row, width, height)
+	in units of simplified cells from the north-west corner of the tile, and `L{f}_offsets`: where rectangles of each tile start.
+	Tiles are numbered from 180W eastwards, then from 90N southwards.
+	"""
+	
+	def __init__(self, directory='biome'):
+		index = json.loads(Path(directory, 'tiles', 'index.json').read_text())
+		self.directory = Path(directory, 'tiles')
+		self.tile_degrees = index['tile_degrees']
+		self.tile_cells = index['tile_cells']
+		self.factors = index['factors']
+		self.years = index['years']
+		self.columns = 360 // self.tile_degrees
+		self.files = {}
+	
+	def factor(self, cell_pixels, min_cell_pixels=4):
+		"Least simplification where cells are at least `min_cell_pixels` wide, when unsimplified cells are `cell_pixels` wide."
+		for f in self.factors:
+			if cell_pixels * f >= min_cell_pixels:
+				return f
+		return self.factors[-1]
+	
+	def level(self, year, f):
+		try:
+			arrays = self.files[year, f]
+		except KeyError:
+			with np.load(self.directory / f'{year}.npz') as npz:
+				arrays = self.files[year, f] = npz[f'L{f}'], npz[f'L{f}_offsets']
+		return arrays
+	
+	def rects(self, year, x, y, f):
+		"Rectangles of the tile with south-west corner (x, y)."
+		rects, offsets = self.level(year, f)
+		n = (90 - y - self.tile_degrees) // self.tile_degrees * self.columns + (x + 180) // self.tile_degrees
+		return rects[offsets[n]:offsets[n + 1]]
@@ -3,151 +3,429 @@
 
 import gi
 gi.require_version('Gtk', '3.0')
-gi.require_version('Rsvg', '2.0')
-gi.require_version('GdkPixbuf', '2.0')
-from gi.repository import Gtk, Gdk, GObject, GLib, Rsvg, GdkPixbuf
+from gi.repository import Gtk, Gdk, GObject, GLib
 
 import cairo
 import math
+import numpy as np
 from itertools import product
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from enum import Enum, auto
 from random import uniform
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import os
 
-from game_widget import GameWidget, surface, quantize_down, quantize_up, float_range
+from game_widget import GameWidget, surface, quantize_down, quantize_up, float_range, quantized_float_range
+from tile_renderer import TileRenderer, TilePending, TileMissing
+from query import PointQuery
+from projection import projections
+from analysis import region_composition, format_composition, elevation_profile
 
 
 class ChronoMaps(GameWidget):
-	biome_imgs = 'biome', 'svg'
-	topo_imgs = 'topo', 'png'
-	
-	def __init__(self):
+	def __init__(self, cache_dir=None):
 		super().__init__()
-		self.earth_degree = 42
+		self.renderer = TileRenderer(cache_dir)
+		self.renderer.wait_for_tiles = False
+		self.renderer.tile_ready_action = lambda x, y: GLib.idle_add(self.tile_ready, x, y)
+		self.renderer.tile_error_action = lambda x, y, error: GLib.idle_add(self.tile_failed, x, y, error)
+		self.earth_degree = self.renderer.pixels_per_degree
+		self.terrain_scale_max *= self.earth_degree / 42
 		self.earth_horizontal_size = self.earth_degree * 360
 		self.earth_vertical_size = self.earth_degree * 180		
 		self.biome_year = None
+		self.query = PointQuery(self.renderer.dem, self.renderer.biome_cube)
+		self.readout_action = None
+		self.path_close_distance = 30
+		self.profile = None
+		self.composition = None
+		self.prefetch_lookahead = 0.5 # seconds of panning ahead
+		self.prefetch_zoom = 1.5 # scale change ahead
+		self.prefetch_bytes = 128 * 1024**2 # limit of prefetched tiles not shown yet, oldest ones are evicted first
+		self.prefetched = OrderedDict() # key in the tile cache -> size, of prefetched tiles not shown yet
+		self.prefetched_bytes = 0
+		self.render_threads = os.cpu_count()
+		self.render_pool = ThreadPoolExecutor(self.render_threads)
+		self.min_band_height = 64
+		self.projection = None # native equirectangular tiles
+		self.show_contours = self.renderer.dem is not None
+		self.grid_reduced = False # grid drawn at interaction quality, to be refined
 		self.set_year_bp(0)
 	
-	def load_pixbuf(self, filename, mime):
-		loader = GdkPixbuf.PixbufLoader.new_with_mime_type(mime)
-		loader.write(Path(filename).read_bytes())
-		loader.close()
-		pixbuf = loader.get_pixbuf()
-		image = Gdk.cairo_surface_create_from_pixbuf(pixbuf, 0, None)
-		width = pixbuf.get_width()
-		height = pixbuf.get_height()
-		return image, width, height
+	def screen_to_geo(self, x, y):
+		"Longitude and latitude of a point on the widget. Works on scalars and arrays."
+		tx = (x - self.screen_width / 2 - self.terrain_x) * self.terrain_scale
+		ty = (y - self.screen_height / 2 - self.terrain_y) * self.terrain_scale
+		if self.projection is not None:
+			# Projected map: terrain is map units times `earth_degree`, north up. Points off the map have NaN latitude.
+			lon, lat, valid = projections[self.projection].inverse(tx / self.earth_degree, -ty / self.earth_degree)
+			return (lon + 180) % 360 - 180, np.where(valid, lat, np.nan)
+		return (tx / self.earth_degree + 180) % 360 - 180, self.renderer.tile_step - ty / self.earth_degree
 	
-	def load_svg(self, filename):
-		rsvg = Rsvg.Handle.new_from_file(filename)
-		image = cairo.RecordingSurface(cairo.Content.COLOR_ALPHA, (0, 0, rsvg.props.width, rsvg.props.height))
-		ctx = cairo.Context(image)
+	def geo_to_screen(self, lon, lat):
+		if self.projection is not None:
+			u, v = projections[self.projection].forward(lon, lat)
+			tx = u * self.earth_degree
+			ty = -v * self.earth_degree
+		else:
+			tx = lon * self.earth_degree
+			ty = (self.renderer.tile_step - lat) * self.earth_degree
+		return tx / self.terrain_scale + self.screen_width / 2 + self.terrain_x, ty / self.terrain_scale + self.screen_height / 2 + self.terrain_y
+	
+	def pointer_moved(self, x, y):
+		if self.readout_action is None:
+			return
 		
-		rect = Rsvg.Rectangle()
-		rect.width = rsvg.props.width
-		rect.height = rsvg.props.height
+		lon, lat = self.screen_to_geo(x, y)
+		if not -90 <= lat <= 90:
+			self.readout_action("")
+			return
 		
-		rsvg.render_document(ctx, rect)
+		elevation, biome, name = self.query.at(lon, lat, self.biome_year)
+		text = f"{abs(lat):.2f}°{'N' if lat >= 0 else 'S'} {abs(lon):.2f}°{'E' if lon >= 0 else 'W'}"
+		if elevation is not None:
+			text += f"  {elevation:.0f} m"
+		if name is not None:
+			text += f"  {name}"
+		self.readout_action(text)
+	
+	def path_ready(self):
+		points = np.array(self.path_points, dtype=np.float64)
+		closed = len(points) >= 3 and math.hypot(*(points[0] - points[-1])) <= self.path_close_distance
 		
-		width = rsvg.props.width
-		height = rsvg.props.height
-		return image, width, height
+		if self.projection is not None:
+			lons, lats = self.screen_to_geo(points[:, 0], points[:, 1])
+			points = points[np.isfinite(lats)] # drawn off the map
+			closed = closed and len(points) >= 3
+		
+		if closed and self.renderer.biome_cube is not None:
+			lons, lats = self.screen_to_geo(points[:, 0], points[:, 1])
+			years, fractions = region_composition(self.renderer.biome_cube, lons, np.clip(lats, -90, 90))
+			if self.get_realized():
+				self.composition = years, fractions
+				self.invalidate_area(self.profile_area(), 'render_composition')
+			else:
+				print(format_composition(years, fractions, self.renderer.biome_cube.names)) # no window to show it in
+		elif not closed and len(points) >= 2 and self.renderer.dem is not None:
+			lons, lats = self.screen_to_geo(points[:, 0], points[:, 1])
+			self.profile = elevation_profile(self.renderer.dem, lons, np.clip(lats, -90, 90))
+			self.invalidate_area(self.profile_area(), 'render_profile')
+		
+		super().path_ready()
 	
-	@surface
-	def load_image(self, filename):
-		ext = filename.split('.')[-1]
-		if ext == 'png':
-			return self.load_pixbuf(filename, 'image/png')
-		elif ext == 'svg':
-			return self.load_svg(filename)
-		else:
-			raise NotImplementedError
+	def begin_path_follow(self):
+		if self.profile is not None:
+			self.profile = None
+			self.invalidate_area(self.profile_area(), 'render_profile')
+		if self.composition is not None:
+			self.composition = None
+			self.invalidate_area(self.profile_area(), 'render_composition')
+		super().begin_path_follow()
 	
-	def set_year_bp(self, year_bp):
-		biome_dir, biome_ext = self.biome_imgs
-		years = [int(p.stem) for p in Path(biome_dir).iterdir() if p.suffix == '.' + biome_ext]
-		#print(year_bp, [_y for _y in years if _y >= -year_bp])
-		year = min(_y for _y in years if _y >= -year_bp)
-		if year == self.biome_year: return
-		self.biome_year = year
-		self.invalidate('render_grid')
+	def profile_area(self):
+		margin = 20
+		height = 160
+		return margin, self.screen_height - height - margin, max(self.screen_width - 2 * margin, 1), height
 	
-	def get_tile(self, x, y, s):
-		#print(x, y)
-		if s <= 1:
-			s = 1
-		elif 1 < s <= 2:
-			s = 2
-		elif 2 < s <= 4:
-			s = 4
-		else:
-			s = 8
+	def draw_overlays(self, ctx):
+		if self.profile is not None:
+			x, y, width, height = self.profile_area()
+			ctx.set_source_surface(self.render_profile(), x, y)
+			ctx.paint()
+		if self.composition is not None:
+			x, y, width, height = self.profile_area()
+			ctx.set_source_surface(self.render_composition(), x, y)
+			ctx.paint()
+	
+	@surface
+	def render_composition(self, threshold=0.01):
+		"Biome composition of the area inside the last closed path through all epochs, as stacked areas, oldest epoch on the left."
+		years, fractions = self.composition
+		cube = self.renderer.biome_cube
+		x, y, width, height = self.profile_area()
+		surface = cairo.ImageSurface(cairo.Format.ARGB32, width, height)
+		ctx = cairo.Context(surface)
+		ctx.set_source_rgba(0, 0, 0, 0.6)
+		ctx.paint()
+		
+		pad = 10
+		top = pad + 16
+		order = np.argsort(years)[::-1] # years before present, oldest first
+		years = np.asarray(years)[order]
+		fractions = fractions[order]
+		shown = [_n for _n in range(fractions.shape[1]) if fractions[:, _n].max() >= threshold]
+		span = max(float(years[0] - years[-1]), 1)
+		xs = pad + (years[0] - years) / span * (width - 2 * pad)
+		chart_height = height - top - pad
 		
-		if not -180 <= x < 180: x = (x + 180) % 360 - 180
-		if not -90 <= y < 90: y = (y + 90) % 180 - 90 
-		#print(" ", x, y)
+		below = np.zeros(len(years))
+		for n in shown:
+			above = below + fractions[:, n]
+			ctx.move_to(xs[0], top + (1 - below[0]) * chart_height)
+			for px, f in zip(xs, above):
+				ctx.line_to(px, top + (1 - f) * chart_height)
+			for px, f in zip(xs[::-1], below[::-1]):
+				ctx.line_to(px, top + (1 - f) * chart_height)
+			ctx.close_path()
+			ctx.set_source_rgba(*cube.palette[n], 0.9)
+			ctx.fill()
+			below = above
 		
-		topo_dir, topo_ext = self.topo_imgs
-		image, width, height = self.load_image(f'{topo_dir}/{x:+}{y:+}s{s}.{topo_ext}')
-		return image, width, height
+		ctx.set_font_size(12)
+		ctx.move_to(pad, pad + 10)
+		ctx.set_source_rgb(1, 1, 1)
+		ctx.show_text(f"{years[0]} .. {years[-1]} BP ")
+		main = sorted(shown, key=lambda _n: -fractions[-1, _n])[:4]
+		for n in main:
+			ctx.set_source_rgb(*cube.palette[n])
+			ctx.show_text("\u25a0 ")
+			ctx.set_source_rgb(1, 1, 1)
+			ctx.show_text(f"{cube.names[n]} {fractions[-1, n]:.0%}  ")
+		
+		surface.flush()
+		return surface
 	
 	@surface
-	def render_grid(self):
-		terrain_scale = self.terrain_scale
-		viewport_width, viewport_height, viewport_left, viewport_right, viewport_top, viewport_bottom = self.viewport_extents()
-		
-		surface = cairo.ImageSurface(cairo.Format.RGB24, self.screen_width + 2 * self.scroll_redraw_rect_x, self.screen_height + 2 * self.scroll_redraw_rect_y)
+	def render_profile(self):
+		"Elevation profile of the last drawn path."
+		distances, elevations = self.profile
+		x, y, width, height = self.profile_area()
+		surface = cairo.ImageSurface(cairo.Format.ARGB32, width, height)
 		ctx = cairo.Context(surface)
-		ctx.translate((self.screen_width + 2 * self.scroll_redraw_rect_x) / 2 + self.terrain_x, (self.screen_height + 2 * self.scroll_redraw_rect_y) / 2 + self.terrain_y)
-		ctx.scale(1 / terrain_scale, 1 / terrain_scale)
-		ctx.set_source_rgb(1, 1, 1)
+		ctx.set_source_rgba(0, 0, 0, 0.6)
 		ctx.paint()
 		
-		ctx.set_operator(cairo.Operator.OVER)
-		ctx.save()
-		ctx.translate(-self.earth_horizontal_size / 2, -self.earth_vertical_size / 2 + (15 * self.earth_degree))
-		biome_dir, biome_ext = self.biome_imgs
-		biome_image, biome_image_width, biome_image_height = self.load_image(f'{biome_dir}/{self.biome_year}.{biome_ext}')
-		ctx.scale(self.earth_horizontal_size / biome_image_width, self.earth_vertical_size / biome_image_height)
-		ctx.set_source_surface(biome_image)
-		ctx.rectangle(0, 0, biome_image_width, biome_image_height)
-		ctx.clip()
-		ctx.paint_with_alpha(0.5)
-		ctx.restore()
+		pad = 10
+		top = pad + 16
+		low = min(float(elevations.min()), 0)
+		high = max(float(elevations.max()), 0)
+		sx = (width - 2 * pad) / max(distances[-1], 1e-6)
+		sy = (height - top - pad) / max(high - low, 1)
 		
-		ctx.push_group()
-		ctx.set_operator(cairo.Operator.OVER)
-		ctx.set_source_rgb(0, 1, 0)
-		ctx.paint()
-		ctx.set_operator(cairo.Operator.MULTIPLY)
-		for x, y in self.grid_points(self.earth_degree * 15, self.earth_degree * 15):
+		ctx.move_to(pad, top + (high - low) * sy)
+		for d, e in zip(distances, elevations):
+			ctx.line_to(pad + d * sx, top + (high - e) * sy)
+		ctx.line_to(pad + distances[-1] * sx, top + (high - low) * sy)
+		ctx.close_path()
+		ctx.set_source_rgba(0.6, 0.8, 0.4, 0.9)
+		ctx.fill()
+		
+		ctx.move_to(pad, top + high * sy)
+		ctx.line_to(width - pad, top + high * sy)
+		ctx.set_line_width(1)
+		ctx.set_source_rgba(0.3, 0.5, 1, 0.9)
+		ctx.stroke()
+		
+		ctx.move_to(pad, pad + 10)
+		ctx.set_font_size(12)
+		ctx.set_source_rgb(1, 1, 1)
+		ctx.show_text(f"{distances[-1]:.0f} km, {float(elevations.min()):.0f} m .. {float(elevations.max()):.0f} m")
+		
+		surface.flush()
+		return surface
+	
+	def handle_configure_event(self, drawingarea, event):
+		self.discard_surfaces('render_profile', 'render_composition')
+		super().handle_configure_event(drawingarea, event)
+	
+	def set_projection(self, name):
+		"Switch to one of `projection.projections`, keeping the same place in the middle of the widget."
+		projection = None if name == 'equirectangular' else name
+		if projection == self.projection:
+			return
+		
+		lon, lat = self.screen_to_geo(self.screen_width / 2, self.screen_height / 2)
+		if not np.isfinite(lat):
+			lon, lat = 0, 0
+		self.projection = projection
+		x, y = self.geo_to_screen(lon, np.clip(lat, -89, 89))
+		self.terrain_x += self.screen_width / 2 - float(x)
+		self.terrain_y += self.screen_height / 2 - float(y)
+		self.recalculate_viewport()
+		self.invalidate('render_grid', 'render_items')
+	
+	def set_color_ramp(self, ramp, sea_level=0):
+		"Restyle the relief, see `color_ramp.py`. Tiles are coloured again from their elevation, nothing is regenerated."
+		self.renderer.set_color_ramp(ramp, sea_level)
+		self.invalidate('render_grid')
+	
+	def set_year_bp(self, year_bp):
+		year = self.renderer.biome_epoch(year_bp)
+		if year == self.biome_year: return
+		old_year = self.biome_year
+		self.biome_year = year
+		
+		changed = self.renderer.changed_tiles(old_year, year)
+		if changed is not None and self.projection is None and 'render_grid' in self.rendered_surface:
+			self.update_grid_tiles(changed)
+		else:
+			self.invalidate('render_grid')
+	
+	def visible_tiles(self, coarser=False):
+		"Positions in terrain coordinates and keys of the tiles in the viewport. Tiles one level of detail coarser, if requested."
+		scale = self.terrain_scale * 2 if coarser else self.terrain_scale
+		yield from self.tiles_in(self.viewport_left, self.viewport_right, self.viewport_top, self.viewport_bottom, scale)
+	
+	def tiles_in(self, left, right, top, bottom, scale):
+		"Positions in terrain coordinates and keys of the tiles covering the rectangle, at level of detail for `scale`."
+		tile_size = self.earth_degree * self.renderer.tile_step
+		if self.projection is not None:
+			yield from self.projected_tiles_in(left, right, top, bottom, scale)
+			return
+		for x, y in product(quantized_float_range(left, right, tile_size), quantized_float_range(top, bottom, tile_size)):
 			xx = int(x / self.earth_degree)
 			yy = -int(y / self.earth_degree)
 			if not -90 <= yy < 90: continue
-			surf, w, h = self.get_tile(xx, yy, terrain_scale)
-			ctx.save()
-			ctx.translate(x, y)
-			ctx.rectangle(0, 0, self.earth_degree * 15, self.earth_degree * 15)
-			ctx.clip()
-			ctx.scale((self.earth_degree * 15 + 1) / w, (self.earth_degree * 15 + 1) / h)
-			ctx.set_source_surface(surf)
-			ctx.paint()
-			ctx.restore()
-		ctx.set_operator(cairo.Operator.ADD)
-		ctx.set_source_rgb(0.25, 0.25, 0.25)
-		ctx.paint()
-		ctx.pop_group_to_source()
-		ctx.set_operator(cairo.Operator.HSL_LUMINOSITY)
+			yield x, y, self.renderer.tile_key(xx, yy, scale)
+	
+	def projected_tiles_in(self, left, right, top, bottom, scale):
+		"Like `tiles_in` for the projected map, keys are column and row from the map origin and level of detail."
+		step = self.renderer.tile_step
+		tile_size = self.earth_degree * step
+		u0, v0, u1, v1 = projections[self.projection].bounds
+		lod = self.renderer.tile_lod(scale)
+		for x, y in product(quantized_float_range(left, right, tile_size), quantized_float_range(top, bottom, tile_size)):
+			i = round(x / tile_size)
+			j = round(y / tile_size)
+			if (i + 1) * step <= u0 or i * step >= u1 or -j * step <= v0 or -(j + 1) * step >= v1:
+				continue
+			yield x, y, (i, j, lod)
+	
+	def tile_image(self, key):
+		"Map tile for the key from `tiles_in`, in the current projection and epoch."
+		if self.projection is not None:
+			return self.renderer.projected_tile(self.projection, *key, self.biome_year)
+		return self.renderer.map_tile(*key, self.biome_year)
+	
+	def has_tile_image(self, key):
+		return self.tile_cache_key(key) in self.renderer.rendered_surface
+	
+	def tile_cache_key(self, key):
+		"Key of the tile image in the tile cache."
+		if self.projection is not None:
+			return self.renderer.projected_tile_key(self.projection, *key, self.biome_year)
+		return self.renderer.map_tile_key(*key, self.biome_year)
+	
+	def predicted_tiles(self):
+		"Keys of the tiles the viewport is about to reach: ahead of the pan, and at the next scale when zooming."
+		(vx, vy), zoom = self.predicted_motion()
+		scale = self.terrain_scale
+		left, right, top, bottom = self.viewport_left, self.viewport_right, self.viewport_top, self.viewport_bottom
+		
+		areas = []
+		if vx or vy:
+			# Terrain follows the pointer, so the viewport moves the other way.
+			dx = -vx * self.prefetch_lookahead * scale
+			dy = -vy * self.prefetch_lookahead * scale
+			areas.append((left + dx, right + dx, top + dy, bottom + dy, scale))
+		if zoom:
+			next_scale = min(max(scale * self.prefetch_zoom ** zoom, self.terrain_scale_min), self.terrain_scale_max)
+			cx = (left + right) / 2
+			cy = (top + bottom) / 2
+			k = next_scale / scale / 2
+			areas.append((cx - (right - left) * k, cx + (right - left) * k, cy - (bottom - top) * k, cy + (bottom - top) * k, next_scale))
+		
+		seen = set()
+		for area in areas:
+			for x, y, key in self.tiles_in(*area):
+				if key not in seen:
+					seen.add(key)
+					yield key
+	
+	def prefetch(self):
+		"""
+		Composite one predicted tile that is not in memory yet. Prefetched tiles take at most `prefetch_bytes` until they are
+		shown, beyond that the oldest of them are evicted, so prefetch never evicts tiles that were shown.
+		"""
+		cache = self.renderer.rendered_surface
+		for cache_key in [_key for _key in self.prefetched if _key not in cache]: # evicted by the cache itself
+			self.prefetched_bytes -= self.prefetched.pop(cache_key)
+		
+		for key in self.predicted_tiles():
+			cache_key = self.tile_cache_key(key)
+			if cache_key in cache:
+				continue
+			while self.prefetched and self.prefetched_bytes >= self.prefetch_bytes:
+				old_key, size = self.prefetched.popitem(last=False)
+				self.prefetched_bytes -= size
+				try:
+					del cache[old_key]
+				except KeyError:
+					pass
+			try:
+				size = cache.size_of(self.tile_image(key))
+			except TilePending:
+				continue
+			self.prefetched[cache_key] = size
+			self.prefetched_bytes += size
+			return True
+		return False
+	
+	def tiles_shown(self, tiles):
+		"Visible tiles are not prefetched ones any more, they stay in the cache as long as it keeps them."
+		for x, y, key in tiles:
+			self.prefetched_bytes -= self.prefetched.pop(self.tile_cache_key(key), 0)
+	
+	def cached_projected_key(self, key):
+		"Key of the projected tile at this or another level of detail that is in memory, coarser levels first. Raises TilePending if there is none."
+		i, j, lod = key
+		levels = sorted(self.renderer.topo_levels, key=lambda _level: (_level < lod, abs(_level - lod)))
+		for level in levels:
+			if self.has_tile_image((i, j, level)):
+				return i, j, level
+		raise TilePending(i, j)
+	
+	def paint_tile(self, ctx, x, y, key, fast=False):
+		"""
+		Paint the map tile. Fast: nothing is composited or resampled. Tiles not in memory are painted as bare relief, projected
+		ones from another level of detail in memory or as placeholders. Everything goes through the cheapest filter.
+		"""
+		tile_size = self.earth_degree * self.renderer.tile_step
+		try:
+			if fast and not self.has_tile_image(key):
+				if self.projection is None:
+					source, w, h = self.renderer.preview_tile(*key)
+				else:
+					surf, w, h = self.tile_image(self.cached_projected_key(key))
+					source = cairo.SurfacePattern(surf)
+			else:
+				surf, w, h = self.tile_image(key)
+				source = cairo.SurfacePattern(surf)
+		except TileMissing:
+			ctx.rectangle(x, y, tile_size, tile_size)
+			ctx.set_source_rgb(0.6, 0.6, 0.6)
+			ctx.fill()
+			return
+		except TilePending:
+			ctx.rectangle(x, y, tile_size, tile_size)
+			ctx.set_source_rgb(0.9, 0.9, 0.9)
+			ctx.fill()
+			return
+		ctx.save()
+		ctx.translate(x, y)
+		ctx.rectangle(0, 0, tile_size, tile_size)
+		ctx.clip()
+		ctx.scale((tile_size + 1) / w, (tile_size + 1) / h)
+		if fast and isinstance(source, cairo.SurfacePattern):
+			source.set_filter(cairo.Filter.FAST)
+		ctx.set_source(source)
 		ctx.paint()
+		ctx.restore()
+	
+	def paint_graticule(self, ctx):
+		viewport_width, viewport_height, viewport_left, viewport_right, viewport_top, viewport_bottom = self.viewport_extents()
+		tile_size = self.earth_degree * self.renderer.tile_step
 		
-		for x in self.grid_lines_horizontal(self.earth_degree * 15):
-			ctx.move_to(x, viewport_top)
-			ctx.line_to(x, viewport_bottom)
-		for y in self.grid_lines_vertical(self.earth_degree * 15):
-			ctx.move_to(viewport_left, y)
-			ctx.line_to(viewport_right, y)
+		if self.projection is not None:
+			self.projected_graticule(ctx)
+		else:
+			for x in self.grid_lines_horizontal(tile_size):
+				ctx.move_to(x, viewport_top)
+				ctx.line_to(x, viewport_bottom)
+			for y in self.grid_lines_vertical(tile_size):
+				ctx.move_to(viewport_left, y)
+				ctx.line_to(viewport_right, y)
 		
 		ctx.save()
 		ctx.identity_matrix()
@@ -156,7 +434,79 @@ class ChronoMaps(GameWidget):
 		ctx.set_source_rgba(0.75, 0.75, 0.75, 0.33)
 		ctx.stroke()
 		ctx.restore()
+	
+	def paint_contours(self, ctx, tiles):
+		"Contour lines of the tiles, with the shelf edge of the Last Glacial Maximum stronger. Paths are cached per tile, like the tiles."
+		if not self.show_contours or self.projection is not None:
+			return
+		tile_size = self.earth_degree * self.renderer.tile_step
+		keys = list({_key for (_x, _y, _key) in tiles})
+		contours = dict(zip(keys, self.render_pool.map(lambda _key: self.renderer.tile_contours(*_key), keys)))
+		
+		for kind, width, rgba in (('levels', 1, (0.2, 0.2, 0.2, 0.25)), ('shelf', 1.5, (0, 0.25, 0.6, 0.8))):
+			for x, y, key in tiles:
+				ctx.save()
+				ctx.translate(x, y)
+				ctx.scale(tile_size, tile_size)
+				contour_lines, paths = contours[key]
+				ctx.append_path(paths[kind])
+				ctx.restore()
+			
+			ctx.save()
+			ctx.identity_matrix()
+			ctx.set_line_width(width)
+			ctx.set_operator(cairo.Operator.OVER)
+			ctx.set_source_rgba(*rgba)
+			ctx.stroke()
+			ctx.restore()
+	
+	def projected_graticule(self, ctx):
+		"Meridians and parallels at tile boundaries, as projected polylines. Parts off the map are left out."
+		projection = projections[self.projection]
+		u0, v0, u1, v1 = projection.bounds
+		step = self.renderer.tile_step
+		along = np.linspace(0, 1, 181)
+		lines = [(np.full_like(along, _lon), -90 + 180 * along) for _lon in range(-180, 181, step)]
+		lines += [(-180 + 360 * along, np.full_like(along, _lat)) for _lat in range(-90 + step, 90, step)]
+		for lons, lats in lines:
+			u, v = projection.forward(lons, lats)
+			inside = (u0 <= u) & (u <= u1) & (v0 <= v) & (v <= v1)
+			pen_down = False
+			for x, y, draw in zip(u * self.earth_degree, -v * self.earth_degree, inside):
+				if draw and pen_down:
+					ctx.line_to(x, y)
+				elif draw:
+					ctx.move_to(x, y)
+				pen_down = draw
+	
+	@surface
+	def render_grid(self):
+		terrain_scale = self.terrain_scale
+		viewport_width, viewport_height, viewport_left, viewport_right, viewport_top, viewport_bottom = self.viewport_extents()
+		
+		surface = cairo.ImageSurface(cairo.Format.RGB24, self.screen_width + 2 * self.scroll_redraw_rect_x, self.screen_height + 2 * self.scroll_redraw_rect_y)
+		ctx = cairo.Context(surface)
+		ctx.translate((self.screen_width + 2 * self.scroll_redraw_rect_x) / 2 + self.terrain_x, (self.screen_height + 2 * self.scroll_redraw_rect_y) / 2 + self.terrain_y)
+		ctx.scale(1 / terrain_scale, 1 / terrain_scale)
+		ctx.set_source_rgb(1, 1, 1)
+		ctx.paint()
+		
+		# While the view moves: no compositing of new tiles, no lines, and one level of detail coarser for the native map.
+		# Projected tiles stay at this level, they are resampled from composites of the same level. Refined when input stops.
+		fast = self.interacting
+		self.grid_reduced = fast
+		tiles = list(self.visible_tiles(coarser=fast and self.projection is None))
+		self.tiles_shown(tiles)
+		if not fast:
+			self.composite_tiles(tiles)
 		
+		height = surface.get_height()
+		band_height = max(math.ceil(height / self.render_threads), self.min_band_height)
+		list(self.render_pool.map(lambda _top: self.paint_band(surface, _top, band_height, tiles, fast), range(0, height, band_height)))
+		
+		if not fast:
+			self.paint_contours(ctx, tiles)
+			self.paint_graticule(ctx)
 		
 		'''
 		min_viewport_top = -self.earth_vertical_size / 2
@@ -208,13 +558,81 @@ class ChronoMaps(GameWidget):
 		
 		surface.flush()
 		
-		surface_r = cairo.RecordingSurface(cairo.Content.COLOR_ALPHA, None)
-		ctx = cairo.Context(surface_r)
-		ctx.translate(-(self.screen_width + 2 * self.scroll_redraw_rect_x) / 2 - self.terrain_x, -(self.screen_height + 2 * self.scroll_redraw_rect_y) / 2 - self.terrain_y)
-		ctx.set_source_surface(surface)
-		ctx.paint()
-		surface_r.flush()
-		return surface_r
+		# Image surface (not a recording) with origin in the terrain center, so partial redraws only blit the clipped area.
+		surface.set_device_offset((self.screen_width + 2 * self.scroll_redraw_rect_x) / 2 + self.terrain_x, (self.screen_height + 2 * self.scroll_redraw_rect_y) / 2 + self.terrain_y)
+		return surface
+	
+	def refine(self):
+		if self.grid_reduced:
+			super().refine()
+	
+	def tile_failed(self, x, y, error):
+		"Generation of a topo tile failed: tell the user once and paint the tile as missing."
+		if self.readout_action is not None:
+			self.readout_action(f"Tile {x:+}{y:+} could not be generated: {error}")
+		return self.tile_ready(x, y)
+	
+	def tile_ready(self, x, y):
+		"Generated topo tile arrived, paint it over the placeholder."
+		if self.projection is not None:
+			self.invalidate('render_grid') # projected tiles do not map to source tiles one to one
+		elif 'render_grid' in self.rendered_surface:
+			self.update_grid_tiles({(x, y)})
+		return False
+	
+	def composite_tiles(self, tiles):
+		"Composite the tiles that are not in memory yet, each once, in parallel."
+		missing = {_key for (_x, _y, _key) in tiles if not self.has_tile_image(_key)}
+		
+		def composite(key):
+			try:
+				self.tile_image(key)
+			except TilePending:
+				pass
+		
+		list(self.render_pool.map(composite, missing))
+	
+	def paint_band(self, surface, top, band_height, tiles, fast=False):
+		"Paint tiles crossing rows `top` to `top + band_height` of the grid surface. Bands are disjoint parts of the same pixels, painted by separate threads."
+		width = surface.get_width()
+		height = min(band_height, surface.get_height() - top)
+		band = surface.create_for_rectangle(0, top, width, height)
+		ctx = cairo.Context(band)
+		ctx.translate(width / 2 + self.terrain_x, surface.get_height() / 2 + self.terrain_y - top)
+		ctx.scale(1 / self.terrain_scale, 1 / self.terrain_scale)
+		
+		tile_size = self.earth_degree * self.renderer.tile_step
+		band_top = (top - surface.get_height() / 2 - self.terrain_y) * self.terrain_scale
+		band_bottom = band_top + height * self.terrain_scale
+		for x, y, key in tiles:
+			if y < band_bottom and y + tile_size > band_top:
+				self.paint_tile(ctx, x, y, key, fast)
+		band.flush()
+		band.finish()
+	
+	def update_grid_tiles(self, changed):
+		"Recomposite only the tiles of the current frame that are in `changed`, instead of the whole frame."
+		
+		surface = self.rendered_surface['render_grid']
+		tile_size = self.earth_degree * self.renderer.tile_step
+		tiles = [(_x, _y, _key) for (_x, _y, _key) in self.visible_tiles() if _key[:2] in changed]
+		if not tiles:
+			return
+		
+		ctx = cairo.Context(surface) # device offset puts the origin in terrain center
+		ctx.scale(1 / self.terrain_scale, 1 / self.terrain_scale)
+		for x, y, key in tiles:
+			self.paint_tile(ctx, x, y, key)
+		
+		for x, y, key in tiles:
+			ctx.rectangle(x, y, tile_size, tile_size)
+		ctx.clip()
+		self.paint_contours(ctx, tiles)
+		self.paint_graticule(ctx)
+		surface.flush()
+		
+		for x, y, key in tiles:
+			self.invalidate_area((x / self.terrain_scale + self.screen_width / 2 + self.terrain_x, y / self.terrain_scale + self.screen_height / 2 + self.terrain_y, tile_size / self.terrain_scale, tile_size / self.terrain_scale))
 
 
 class UserInterface:
@@ -231,12 +649,19 @@ class UserInterface:
 		#self.builder.set_translation_domain(translation)
 		self.builder.add_from_file('chronomaps.glade')
 		self.builder.connect_signals(self)
+		self.sea_level = 0
 	
 	def add_map_widget(self, widget):
 		self.map_widget = widget
 		self.main_box.pack_start(widget, True, True, 0)
 		self.main_box.reorder_child(widget, 0)
 	
+	def change_projection(self, combo):
+		self.map_widget.set_projection(combo.get_active_id())
+	
+	def change_color_ramp(self, combo):
+		self.map_widget.set_color_ramp(combo.get_active_id(), self.sea_level)
+	
 	def update_year_bp(self, *args):
 		y = int(self.entry_year_bp.get_text())
 		if y > 120000:
@@ -256,17 +681,71 @@ class UserInterface:
 if __name__ == '__main__':
 	import signal
 	import sys
-	import os
+	import argparse
+	
+	parser = argparse.ArgumentParser(description="Chrono Maps")
+	parser.add_argument('--serve', metavar='PORT', type=int, help="run headless HTTP tile server instead of the window")
+	parser.add_argument('--export', metavar='FILE', help="render region into PNG file instead of showing the window")
+	parser.add_argument('--bbox', metavar='W,S,E,N', default='-180,-90,180,90', help="exported region in degrees")
+	parser.add_argument('--width', type=int, default=4096, help="width of exported image in pixels")
+	parser.add_argument('--year-bp', type=int, default=0, help="exported epoch, in years before present")
+	parser.add_argument('--frames', metavar='PATTERN', help="render time-lapse frames into files like frames/%%04d.png instead of showing the window")
+	parser.add_argument('--years', metavar='START:END:STEP', help="frame years before present, like 120000:0:-1000; default is every epoch")
+	parser.add_argument('--processes', type=int, default=os.cpu_count(), help="processes rendering frames")
+	parser.add_argument('--dry-run', action='store_true', help="only estimate time to render the frames")
+	parser.add_argument('--profile', metavar='DIR', help="profile rendering and input handling, write report into DIR on exit")
+	parser.add_argument('--projection', choices=['equirectangular', 'equal-area', 'web-mercator', 'north-polar', 'south-polar'], default='equirectangular')
+	parser.add_argument('--ramp', default='relief', help="colour ramp of the relief: relief, hypsometric, bathymetry or a JSON file of stops")
+	parser.add_argument('--sea-level', type=float, default=0, help="elevation of the coast in the colour ramp, in metres")
+	parser.add_argument('--no-contours', action='store_true', help="do not draw contour lines and the -120m isobath")
+	args = parser.parse_args()
+	
+	if args.profile:
+		import profiler
+		profiler.start(args.profile)
+	
+	cache_dir = os.environ.get('CHRONOMAPS_CACHE', None)
+	
+	if args.serve:
+		from tile_server import serve
+		serve(port=args.serve, cache_dir=cache_dir, color_ramp=(args.ramp, args.sea_level))
+		sys.exit()
+	
+	if args.export:
+		from export import export_region
+		renderer = TileRenderer(cache_dir)
+		renderer.set_color_ramp(args.ramp, args.sea_level)
+		west, south, east, north = (float(_c) for _c in args.bbox.split(','))
+		export_region(renderer, args.export, west, south, east, north, args.width, renderer.biome_epoch(args.year_bp))
+		sys.exit()
+	
+	if args.frames:
+		from export import export_frames
+		box = tuple(float(_c) for _c in args.bbox.split(','))
+		years_bp = range(*(int(_n) for _n in args.years.split(':'))) if args.years else None
+		if len(box) != 4 or not (box[0] < box[2] and box[1] < box[3]):
+			parser.error(f"--bbox {args.bbox} is empty, west must be less than east and south less than north")
+		if years_bp is not None and not years_bp:
+			parser.error(f"--years {args.years} gives no frames, the step must go from start towards end")
+		export_frames(args.frames, box, args.width, years_bp, args.processes, cache_dir, color_ramp=(args.ramp, args.sea_level), dry_run=args.dry_run)
+		sys.exit()
 	
-
 	#window = gtk.Window(type=gtk.WindowType.TOPLEVEL)
 	#window.set_title('Chrono Maps')
 	
 	ui = UserInterface()
 	
-	map_widget = ChronoMaps()
+	map_widget = ChronoMaps(cache_dir=cache_dir)
 	map_widget.exit_action = ui.window.close
+	map_widget.readout_action = ui.label_readout.set_text
 	ui.add_map_widget(map_widget)
+	map_widget.set_projection(args.projection)
+	ui.combo_projection.set_active_id(args.projection)
+	map_widget.set_color_ramp(args.ramp, args.sea_level)
+	if args.no_contours:
+		map_widget.show_contours = False
+	ui.sea_level = args.sea_level
+	ui.combo_ramp.set_active_id(args.ramp)
 	
 	#header_bar = gtk.HeaderBar()
 	#window.set_titlebar(header_bar)
@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+Coastline polylines of one sea level, as written by `generate_coastline_maps.py`.
+
+File layout: magic, number of rings and points (3 x uint32), table of rings (bounding box as 4 x float32, first point
+and number of points as 2 x uint32), then all points as longitude, latitude pairs of float32.
+"""
+
+import numpy as np
+
+
+magic = 0x54534f43 # 'COST'
+
+ring_dtype = np.dtype([('west', '<f4'), ('south', '<f4'), ('east', '<f4'), ('north', '<f4'), ('start', '<u4'), ('count', '<u4')])
+
+
+def write_coastlines(filename, rings):
+	"Write list of arrays of points (n x 2, longitude and latitude)."
+	table = np.zeros(len(rings), dtype=ring_dtype)
+	start = 0
+	for n, ring in enumerate(rings):
+		table[n] = ring[:, 0].min(), ring[:, 1].min(), ring[:, 0].max(), ring[:, 1].max(), start, len(ring)
+		start += len(ring)
+	
+	with open(filename, 'wb') as fd:
+		fd.write(np.array([magic, len(rings), start], dtype='<u4').tobytes())
+		fd.write(table.tobytes())
+		for ring in rings:
+			fd.write(np.asarray(ring, dtype='<f4').tobytes())
+
+
+class Coastlines:
+	"Memory-mapped rings of one sea level. Only points of the rings that are used are read."
+	
+	def __init__(self, filename):
+		header = np.fromfile(filename, dtype='<u4', count=3)
+		if len(header) < 3 or header[0] != magic:
+			raise ValueError(f"Not a coastline file: {filename}")
+		rings, points = int(header[1]), int(header[2])
+		self.rings = np.memmap(filename, dtype=ring_dtype, mode='r', offset=12, shape=(rings,))
+		self.points = np.memmap(filename, dtype='<f4', mode='r', offset=12 + rings * ring_dtype.itemsize, shape=(points, 2))
+	
+	def __len__(self):
+		return len(self.rings)
+	
+	def select(self, west, south, east, north):
+		"Indices of rings whose bounding box intersects the box."
+		r = self.rings
+		return np.nonzero((r['east'] >= west) & (r['west'] <= east) & (r['north'] >= south) & (r['south'] <= north))[0]
+	
+	def ring(self, n):
+		start, count = int(self.rings['start'][n]), int(self.rings['count'][n])
+		return self.points[start:start + count]
+	
+	def rings_in(self, west, south, east, north):
+		for n in self.select(west, south, east, north):
+			yield self.ring(n)
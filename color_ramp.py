@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+Colour ramps of relief tiles. Tiles store elevation in metres as 16-bit samples biased by 32768, and the viewer colours them while
+decoding, through a lookup table with the colour of every one of the 65536 samples. Changing the ramp or the sea level only
+recomputes the table, tiles are not rebuilt.
+
+A ramp is a name from `ramps` or a JSON file with a list of stops `[elevation, [r, g, b]]`, colours in between are interpolated.
+"""
+
+import json
+import numpy as np
+from math import pi
+from pathlib import Path
+
+
+bias = 32768
+
+
+def elevation_samples(elevation):
+	"16-bit samples of elevation in metres, as stored in tiles."
+	return (np.clip(np.rint(elevation), -bias, bias - 1) + bias).astype(np.uint16)
+
+
+class Relief:
+	"Arctangent ramp of the original tiles: lightness follows elevation, land is tinted red and sea blue."
+	
+	title = "Relief"
+	
+	def colors(self, elevation):
+		k = np.arctan(elevation / 1000) / pi + 1/2
+		rgb = np.zeros(elevation.shape + (3,), dtype=np.uint8)
+		rgb[..., 0] = np.where(elevation >= 0, 128, 0)
+		rgb[..., 1] = (k * 65535 + 0.5).astype(np.uint32) >> 8
+		rgb[..., 2] = np.where(elevation < 0, 128, 0)
+		return rgb
+
+
+class Stops:
+	"Colours interpolated between elevation stops. A step at the coast needs two stops, at -1 and 0."
+	
+	def __init__(self, title, stops):
+		self.title = title
+		self.elevations = np.array([_elevation for (_elevation, _color) in stops], dtype=np.float32)
+		self.rgb = np.array([_color for (_elevation, _color) in stops], dtype=np.float32)
+	
+	def colors(self, elevation):
+		return np.stack([np.interp(elevation, self.elevations, self.rgb[:, _c]) for _c in range(3)], axis=-1).round().astype(np.uint8)
+
+
+ramps = {
+	'relief': Relief(),
+	'hypsometric': Stops("Hypsometric tints", [
+		(-11000, (8, 24, 64)), (-4000, (32, 72, 136)), (-200, (96, 152, 208)), (-1, (168, 208, 236)),
+		(0, (96, 144, 80)), (300, (152, 184, 104)), (1000, (224, 208, 136)), (2500, (176, 120, 72)), (4500, (224, 224, 224)), (9000, (255, 255, 255))
+	]),
+	'bathymetry': Stops("Bathymetry", [
+		(-11000, (0, 0, 32)), (-1000, (0, 32, 96)), (-200, (16, 96, 176)), (-121, (64, 160, 224)), (-120, (160, 224, 248)), (-1, (216, 244, 252)),
+		(0, (128, 128, 128)), (9000, (240, 240, 240))
+	])
+}
+
+
+def load_ramp(spec):
+	"Ramp of the provided name or from the JSON file."
+	try:
+		return ramps[spec]
+	except KeyError:
+		pass
+	return Stops(Path(spec).stem, json.loads(Path(spec).read_text()))
+
+
+def color_lut(ramp, sea_level=0):
+	"Colour of every 16-bit sample as RGB24 pixel, with the coast at `sea_level` metres."
+	rgb = ramp.colors(np.arange(1 << 16, dtype=np.float32) - bias - sea_level).astype(np.uint32)
+	return (0xff000000 | rgb[:, 0] << 16 | rgb[:, 1] << 8 | rgb[:, 2]).astype(np.uint32)
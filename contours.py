@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+Contour lines and isobaths of elevation grids.
+
+Crossings of every level are found for all cells of the grid at once (marching squares in numpy). Segments meet on cell edges,
+so they are joined into polylines by edge number, then simplified to a fraction of a grid cell. Lines of a map tile are kept
+in fractions of the tile size from its north-west corner, so they are drawn at any scale.
+"""
+
+import numpy as np
+
+
+shelf_edge = -120 # sea level of the Last Glacial Maximum, metres
+
+
+# Edges of a cell: 0 top, 1 right, 2 bottom, 3 left. Case bits: 1 top-left, 2 top-right, 4 bottom-right, 8 bottom-left corner
+# above the level. Saddles (5 and 10) depend on the center of the cell, cases 16 to 31 are those with the center above.
+segment_table = np.full((32, 2, 2), -1, dtype=np.int8)
+for case, segments in {
+	1: [(3, 0)], 2: [(0, 1)], 3: [(3, 1)], 4: [(1, 2)], 5: [(3, 0), (1, 2)], 6: [(0, 2)], 7: [(3, 2)],
+	8: [(2, 3)], 9: [(0, 2)], 10: [(0, 1), (2, 3)], 11: [(1, 2)], 12: [(3, 1)], 13: [(0, 1)], 14: [(3, 0)]
+}.items():
+	for center in (0, 16):
+		if case in (5, 10) and center:
+			segments = {5: [(0, 1), (2, 3)], 10: [(3, 0), (1, 2)]}[case]
+		for n, segment in enumerate(segments):
+			segment_table[case + center, n] = segment
+
+
+def levels_between(low, high, interval):
+	"Contour levels, multiples of `interval`, and the shelf edge."
+	levels = set(range(int(np.ceil(low / interval)) * interval, int(high) + 1, interval))
+	if low <= shelf_edge <= high:
+		levels.add(shelf_edge)
+	return sorted(levels)
+
+
+def marching_squares(z, level):
+	"Segments of the contour through grid `z`, as pairs of edge numbers, and (column, row) of the crossing on every edge number."
+	rows, cols = z.shape
+	above = z >= level
+	case = above[:-1, :-1] * 1 + above[:-1, 1:] * 2 + above[1:, 1:] * 4 + above[1:, :-1] * 8
+	r, c = np.nonzero((case != 0) & (case != 15))
+	case = case[r, c]
+	saddle = (case == 5) | (case == 10)
+	center = np.zeros(len(case), dtype=np.int8)
+	center[saddle] = (z[r, c] + z[r, c + 1] + z[r + 1, c] + z[r + 1, c + 1])[saddle] >= 4 * level
+	table = segment_table[case + 16 * center]
+	
+	# Horizontal edge from (r, c) to (r, c + 1) is number 2 (r cols + c), vertical edge from (r, c) to (r + 1, c) is one more.
+	cell_edges = np.stack([2 * (r * cols + c), 2 * (r * cols + c + 1) + 1, 2 * ((r + 1) * cols + c), 2 * (r * cols + c) + 1], axis=-1)
+	pairs = []
+	for n in range(2):
+		present = table[:, n, 0] >= 0
+		index = np.flatnonzero(present)
+		pairs.append(np.stack([cell_edges[index, table[present, n, 0]], cell_edges[index, table[present, n, 1]]], axis=-1))
+	segments = np.concatenate(pairs)
+	
+	edges = np.unique(segments)
+	er, ec = np.divmod(edges // 2, cols)
+	vertical = (edges % 2).astype(bool)
+	z0 = z[er, ec].astype(np.float32)
+	z1 = np.where(vertical, z[np.minimum(er + 1, rows - 1), ec], z[er, np.minimum(ec + 1, cols - 1)]).astype(np.float32)
+	t = (level - z0) / (z1 - z0)
+	points = np.stack([ec + np.where(vertical, 0, t), er + np.where(vertical, t, 0)], axis=-1).astype(np.float32)
+	return np.searchsorted(edges, segments), points
+
+
+def join_segments(segments, count):
+	"Chains of point numbers. Every point is shared by at most two segments, so chains are open polylines or rings."
+	neighbours = np.full((count, 2), -1, dtype=np.int64)
+	ends = segments.ravel()
+	order = np.argsort(ends, kind='stable')
+	first = np.ones(len(order), dtype=bool)
+	first[1:] = ends[order][1:] != ends[order][:-1]
+	neighbours[ends[order], (~first).astype(np.intp)] = segments[order // 2, 1 - order % 2]
+	
+	neighbours = neighbours.tolist()
+	visited = [False] * count
+	chains = []
+	starts = [_p for (_p, (_a, _b)) in enumerate(neighbours) if _b < 0] # open ends first, rings are left over
+	for start in starts + list(range(count)):
+		if visited[start]:
+			continue
+		chain = [start]
+		visited[start] = True
+		previous, point = -1, start
+		while True:
+			a, b = neighbours[point]
+			following = b if a == previous else a
+			if following < 0:
+				break
+			if visited[following]:
+				if following == start:
+					chain.append(start)
+				break
+			chain.append(following)
+			visited[following] = True
+			previous, point = point, following
+		if len(chain) >= 2:
+			chains.append(chain)
+	return chains
+
+
+def simplify(points, starts, ends, tolerance):
+	"""
+	Douglas-Peucker on many polylines at once: polyline `n` is `points[starts[n]:ends[n] + 1]`. Every round splits all intervals
+	at their point furthest from the chord, while it is further than `tolerance`. Returns mask of points kept.
+	"""
+	keep = np.zeros(len(points), dtype=bool)
+	keep[starts] = keep[ends] = True
+	a, b = np.asarray(starts), np.asarray(ends)
+	while len(a):
+		inner = b - a - 1
+		a, b, inner = a[inner > 0], b[inner > 0], inner[inner > 0]
+		if not len(a):
+			break
+		group = np.repeat(np.arange(len(a)), inner)
+		index = np.arange(len(group)) - np.repeat(np.cumsum(inner) - inner, inner) + a[group] + 1
+		d = points[b] - points[a]
+		length = np.hypot(d[:, 0], d[:, 1])
+		middle = points[index] - points[a[group]]
+		cross = np.abs(middle[:, 0] * d[group, 1] - middle[:, 1] * d[group, 0])
+		distance = np.where(length[group] > 0, cross / np.maximum(length[group], 1e-12), np.hypot(middle[:, 0], middle[:, 1]))
+		
+		# Furthest point of every interval: last of the group after sorting by group, then distance.
+		order = np.lexsort((distance, group))
+		last = np.cumsum(inner) - 1
+		furthest = order[last]
+		split = distance[furthest] > tolerance
+		m = index[furthest[split]]
+		keep[m] = True
+		a, b = np.concatenate([a[split], m]), np.concatenate([m, b[split]])
+	return keep
+
+
+class TileContours:
+	"Simplified contour polylines of one tile, points in fractions of the tile size from its north-west corner."
+	
+	def __init__(self, levels, lines):
+		self.levels = levels # level of every line
+		self.lines = lines
+	
+	@property
+	def nbytes(self):
+		return sum(_line.nbytes for _line in self.lines)
+	
+	@classmethod
+	def trace(cls, z, levels, size, tolerance=0.5):
+		"""
+		Contours of the grid `z`, whose samples are centers of cells of a tile `size` cells wide, with one more cell of the
+		neighbouring tiles around it. Lines go half a cell past the tile edge, so that they meet lines of the neighbours.
+		"""
+		line_levels = []
+		lines = []
+		for level in levels:
+			segments, points = marching_squares(z, level)
+			if not len(segments):
+				continue
+			chains = join_segments(segments, len(points))
+			lengths = np.array([len(_chain) for _chain in chains])
+			ends = np.cumsum(lengths) - 1
+			chained = (points[np.concatenate(chains)] - 0.5) / size
+			keep = simplify(chained, ends - lengths + 1, ends, tolerance / size)
+			kept = np.cumsum(keep)[ends]
+			lines.extend(np.split(chained[keep], kept[:-1]))
+			line_levels.extend([level] * len(chains))
+		return cls(line_levels, lines)
+	
+	def save(self, filename):
+		lengths = np.array([len(_line) for _line in self.lines], dtype=np.int64)
+		points = np.concatenate(self.lines) if self.lines else np.zeros((0, 2), dtype=np.float32)
+		with open(filename, 'wb') as fd:
+			np.savez(fd, levels=np.array(self.levels, dtype=np.int32), lengths=lengths, points=points)
+	
+	@classmethod
+	def load(cls, filename):
+		with np.load(filename) as data:
+			lines = np.split(data['points'], np.cumsum(data['lengths'])[:-1]) if len(data['lengths']) else []
+			return cls(data['levels'].tolist(), lines)
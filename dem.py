@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+Digital elevation model stored as a native-endian .npy array.
+
+The GeoTIFF is converted once, after that every process maps the same file, so all of them share one physical copy in the page cache.
+Arrays bigger than memory (15 arc-second model is 15GB) are fine, only the pages being read are loaded.
+"""
+
+import numpy as np
+import os
+import re
+from pathlib import Path
+
+
+def parse_tile_name(tif_file):
+	"Resolution in pixels per degree and north-west corner of an ETOPO file, from names like `ETOPO_2022_v1_15s_N45E000_bed.tif`."
+	m = re.search(r'_(\d+)s_([NS])(\d+)([EW])(\d+)', Path(tif_file).name)
+	if not m:
+		raise ValueError(f"Unrecognized ETOPO file name: {tif_file}")
+	arcsec, ns, lat, ew, lon = m.groups()
+	north = int(lat) if ns == 'N' else -int(lat)
+	west = int(lon) if ew == 'E' else -int(lon)
+	return 3600 // int(arcsec), north, west
+
+
+def array_filename(tif_files):
+	"Name of the array made of all the provided files, i.e. `ETOPO_2022_v1_15s_bed.npy`."
+	if isinstance(tif_files, str):
+		tif_files = [tif_files]
+	path = Path(tif_files[0])
+	return str(path.with_name(re.sub(r'_[NS]\d+[EW]\d+', '', path.name)).with_suffix('.npy'))
+
+
+def convert(tif_files, npy_file=None, strip_rows=512):
+	"""
+	Convert GeoTIFF files into a global memory-mappable .npy file, reading `strip_rows` rows at a time.
+	Either one global file, or tiles (like the 15 arc-second model) placed according to their names.
+	"""
+	
+	from geotiff import GeoTiff
+	
+	if isinstance(tif_files, str):
+		tif_files = [tif_files]
+	if npy_file is None:
+		npy_file = array_filename(tif_files)
+	
+	pixels_per_degree = parse_tile_name(tif_files[0])[0]
+	rows = 180 * pixels_per_degree
+	cols = 360 * pixels_per_degree
+	dtype = None
+	
+	tmp_file = npy_file + '.tmp'
+	target = None
+	for tif_file in tif_files:
+		source = GeoTiff(tif_file).read()
+		if target is None:
+			dtype = np.dtype(source.dtype).newbyteorder('=')
+			target = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=dtype, shape=(rows, cols))
+		
+		ppd, north, west = parse_tile_name(tif_file)
+		if ppd != pixels_per_degree:
+			raise ValueError(f"Mixed resolutions: {tif_files[0]}, {tif_file}")
+		top = (90 - north) * ppd
+		left = (west + 180) * ppd
+		height = min(source.shape[0], rows - top)
+		width = min(source.shape[1], cols - left)
+		
+		for row in range(0, height, strip_rows):
+			n = min(strip_rows, height - row)
+			target[top + row:top + row + n, left:left + width] = source[row:row + n, :width]
+	
+	target.flush()
+	del target
+	os.replace(tmp_file, npy_file)
+	return npy_file
+
+
+def convert_if_needed(tif_files, npy_file=None):
+	if isinstance(tif_files, str):
+		tif_files = [tif_files]
+	if npy_file is None:
+		npy_file = array_filename(tif_files)
+	
+	try:
+		if os.stat(npy_file).st_mtime >= max(os.stat(_tif_file).st_mtime for _tif_file in tif_files):
+			return npy_file
+	except FileNotFoundError:
+		pass
+	
+	print("converting", len(tif_files), "files ->", npy_file)
+	return convert(tif_files, npy_file)
+
+
+class DEM:
+	"Global elevation grid in plate carrée, north-west corner at (-180, 90)."
+	
+	def __init__(self, filename):
+		self.array = np.load(filename, mmap_mode='r')
+		self.rows, self.cols = self.array.shape
+		self.pixels_per_degree = self.cols // 360
+	
+	def box(self, lon, lat, width, height):
+		"View (not a copy) of the area with the south-west corner at (lon, lat), sizes in degrees."
+		ppd = self.pixels_per_degree
+		top = round((90 - lat - height) * ppd)
+		bottom = round((90 - lat) * ppd)
+		left = round((lon + 180) * ppd)
+		right = round((lon + width + 180) * ppd)
+		return self.array[top:bottom, left:right]
+	
+	def sample(self, lons, lats):
+		"Elevation of the cells containing the points. Works on scalars and arrays."
+		rows = np.clip(np.floor((90 - lats) * self.pixels_per_degree).astype(np.intp), 0, self.rows - 1)
+		cols = np.floor((lons + 180) * self.pixels_per_degree).astype(np.intp) % self.cols
+		return self.array[rows, cols]
+	
+	def sample_bilinear(self, lons, lats):
+		"Elevation interpolated between the four nearest cell centers, for arrays of points."
+		fx = (np.asarray(lons) + 180) * self.pixels_per_degree - 0.5
+		fy = (90 - np.asarray(lats)) * self.pixels_per_degree - 0.5
+		x0 = np.floor(fx)
+		y0 = np.floor(fy)
+		wx = fx - x0
+		wy = fy - y0
+		
+		c0 = x0.astype(np.intp) % self.cols
+		c1 = (c0 + 1) % self.cols
+		r0 = np.clip(y0.astype(np.intp), 0, self.rows - 1)
+		r1 = np.clip(r0 + 1, 0, self.rows - 1)
+		
+		top = self.array[r0, c0] * (1 - wx) + self.array[r0, c1] * wx
+		bottom = self.array[r1, c0] * (1 - wx) + self.array[r1, c1] * wx
+		return top * (1 - wy) + bottom * wy
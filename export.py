@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+Export of map regions at any resolution. The image is rendered in horizontal bands and streamed to the file, so memory use is bounded by the band size.
+Sequences of frames for time-lapse videos are rendered on a pool of processes, every one with its own renderer and tile cache.
+"""
+
+import cairo
+import numpy as np
+import shutil
+import time
+from multiprocessing import Pool
+
+from png_writer import PNGWriter
+from tile_renderer import TileRenderer
+
+
+def surface_rgb(surface):
+	"RGB array of an RGB24 image surface."
+	width = surface.get_width()
+	height = surface.get_height()
+	data = np.ndarray(shape=(height, surface.get_stride() // 4), dtype=np.uint32, buffer=surface.get_data())[:, :width]
+	return np.stack([(data >> 16) & 0xff, (data >> 8) & 0xff, data & 0xff], axis=-1).astype(np.uint8)
+
+
+def render_band(renderer, lon, lat, scale, width, height, year):
+	"Band of the map with the top-left corner at (lon, lat), as RGB24 surface."
+	band = cairo.ImageSurface(cairo.Format.RGB24, width, height)
+	ctx = cairo.Context(band)
+	ctx.set_source_rgb(1, 1, 1)
+	ctx.paint()
+	renderer.paint_region(ctx, lon, lat, scale, width, height, year)
+	band.flush()
+	return band
+
+
+def export_region(renderer, filename, west, south, east, north, width, year, band_height=256):
+	"Write PNG of the box between the provided longitudes and latitudes, `width` pixels wide, for the biome epoch `year`."
+	if not (west < east and south < north):
+		raise ValueError("Empty region.")
+	scale = width / (east - west)
+	height = round((north - south) * scale)
+	
+	with PNGWriter(filename, width, height) as writer:
+		for top in range(0, height, band_height):
+			rows = min(band_height, height - top)
+			band = render_band(renderer, west, north - top / scale, scale, width, rows, year)
+			writer.write_rows(surface_rgb(band))
+			band.finish()
+
+
+def frame_epochs(renderer, years_bp=None):
+	"Biome epoch of every frame. All epochs from the oldest one if `years_bp` is not provided, otherwise the epoch shown at every year."
+	if years_bp is None:
+		return list(renderer.biome_years())
+	return [renderer.biome_epoch(_y) for _y in years_bp]
+
+
+worker_renderer = None
+
+
+def init_worker(cache_dir, memory_budget, color_ramp):
+	global worker_renderer
+	worker_renderer = TileRenderer(cache_dir, memory_budget)
+	worker_renderer.set_color_ramp(*color_ramp)
+
+
+def export_frame(job):
+	filename, box, width, year = job
+	start = time.perf_counter()
+	export_region(worker_renderer, filename, *box, width, year)
+	return filename, time.perf_counter() - start
+
+
+def estimate_frame_time(renderer, box, width, year, band_height=256):
+	"Seconds to render one frame, extrapolated from its first band. Tiles are loaded cold, as in a fresh worker."
+	west, south, east, north = box
+	scale = width / (east - west)
+	height = round((north - south) * scale)
+	rows = min(band_height, height)
+	start = time.perf_counter()
+	band = render_band(renderer, west, north, scale, width, rows, year)
+	surface_rgb(band)
+	band.finish()
+	return (time.perf_counter() - start) * height / rows
+
+
+def export_frames(pattern, box, width, years_bp=None, processes=8, cache_dir=None, memory_budget=256 * 1024**2, color_ramp=('relief', 0), dry_run=False):
+	"""
+	Write numbered frames of the box, file names are `pattern % frame_number`.
+	Frames showing the same epoch are rendered once and copied. Returns the list of written files.
+	"""
+	
+	renderer = TileRenderer(cache_dir, memory_budget)
+	renderer.set_color_ramp(*color_ramp)
+	epochs = frame_epochs(renderer, years_bp)
+	if not epochs:
+		raise ValueError("No frames to render.")
+	west, south, east, north = box
+	if not (west < east and south < north):
+		raise ValueError("Empty region.")
+	filenames = [pattern % _n for _n in range(len(epochs))]
+	
+	first_frame = {}
+	for filename, year in zip(filenames, epochs):
+		first_frame.setdefault(year, filename)
+	jobs = [(_filename, box, width, _year) for _year, _filename in first_frame.items()]
+	workers = max(1, min(processes, len(jobs)))
+	
+	if dry_run:
+		frame_time = estimate_frame_time(renderer, box, width, jobs[len(jobs) // 2][3])
+		total = frame_time * len(jobs) / workers
+		print(f"{len(filenames)} frames, {len(jobs)} distinct epochs, about {frame_time:.1f}s per frame, {total:.0f}s on {workers} processes")
+		return []
+	
+	del renderer
+	start = time.perf_counter()
+	with Pool(workers, initializer=init_worker, initargs=(cache_dir, memory_budget, color_ramp)) as pool:
+		for n, (filename, seconds) in enumerate(pool.imap_unordered(export_frame, jobs), 1):
+			print(f"{n}/{len(jobs)} {filename} {seconds:.1f}s")
+	
+	for filename, year in zip(filenames, epochs):
+		if filename != first_frame[year]:
+			shutil.copyfile(first_frame[year], filename)
+	
+	print(f"{len(filenames)} frames in {time.perf_counter() - start:.0f}s")
+	return filenames
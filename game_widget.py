@@ -13,6 +13,7 @@ import math
 from itertools import product
 from time import monotonic
 
+from profiler import profiled
 
 
 def quantize_down(x, m):
@@ -46,6 +47,7 @@ def quantized_float_range(start, stop, step):
 
 def surface(old_method):
 	fname = old_method.__name__
+	render = profiled(old_method)
 	
 	def new_method(self, *args):
 		if args:
@@ -53,12 +55,14 @@ def surface(old_method):
 		else:
 			key = fname
 		
-		if key not in self.rendered_surface:
-			surface = old_method(self, *args)
-			self.rendered_surface[key] = surface
-			return surface
-		else:
+		try:
 			return self.rendered_surface[key]
+		except KeyError:
+			pass
+		
+		surface = render(self, *args)
+		self.rendered_surface[key] = surface
+		return surface
 	
 	new_method.__name__ = fname
 	return new_method
@@ -99,6 +103,16 @@ class GameWidget(gtk.DrawingArea):
 		self.primary_sequence = None
 		
 		self.terrain_scrolling = False
+		self.pan_velocity = 0, 0
+		self.pan_time = monotonic()
+		self.zoom_direction = 0
+		self.zoom_time = monotonic()
+		self.prediction_timeout = 0.3
+		self.prefetch_event = False
+		self.interacting = False
+		self.interaction_time = monotonic()
+		self.refine_delay = 0.25 # seconds without input before the view is drawn again at full quality
+		self.refine_timer = None
 		self.menu_showing = False
 		self.default_menu_ring_color = 1, 1, 1, 0.15
 		self.menu_positions = 12
@@ -114,14 +128,14 @@ class GameWidget(gtk.DrawingArea):
 		
 		self.x11_fixes = True
 		
-		self.connect('configure-event', self.handle_configure_event)
-		self.connect('draw', self.handle_draw)
+		self.connect('configure-event', profiled(self.handle_configure_event))
+		self.connect('draw', profiled(self.handle_draw))
 		
-		self.connect('motion-notify-event', self.handle_mouse_event)
-		self.connect('button-press-event', self.handle_mouse_event)
-		self.connect('button-release-event', self.handle_mouse_event)
-		self.connect('touch-event', self.handle_touch_event)
-		self.connect('scroll-event', self.handle_scroll_event)
+		self.connect('motion-notify-event', profiled(self.handle_mouse_event))
+		self.connect('button-press-event', profiled(self.handle_mouse_event))
+		self.connect('button-release-event', profiled(self.handle_mouse_event))
+		self.connect('touch-event', profiled(self.handle_touch_event))
+		self.connect('scroll-event', profiled(self.handle_scroll_event))
 		
 		#self.connect('dblclick', self.handle_mouse_event)
 		#self.connect('auxclicked', self.handle_auxclicked)
@@ -138,24 +152,45 @@ class GameWidget(gtk.DrawingArea):
 		#self.add_events(gdk.EventMask.KEY_PRESS_MASK)
 		#self.add_events(gdk.EventMask.KEY_RELEASE_MASK)
 	
-	def invalidate(self, *keys):
+	def discard_surfaces(self, *keys):
 		for key in keys:
 			try:
 				self.rendered_surface[key].finish()
 				del self.rendered_surface[key]
 			except KeyError:
 				pass
-		
+	
+	def invalidate(self, *keys):
+		self.discard_surfaces(*keys)
 		self.queue_draw()
 		self.invalidate_event = True
 	
+	def invalidate_area(self, area, *keys):
+		"Like `invalidate`, but only the rectangle `area` = (x, y, width, height) of the widget is redrawn."
+		self.discard_surfaces(*keys)
+		x, y, width, height = area
+		left = math.floor(x)
+		top = math.floor(y)
+		self.queue_draw_area(left, top, math.ceil(x + width) - left, math.ceil(y + height) - top)
+		self.invalidate_event = True
+	
+	def menu_area(self):
+		radius = self.menu_radius + 1
+		return self.pointer_primary_x - radius, self.pointer_primary_y - radius, 2 * radius, 2 * radius
+	
+	def path_area(self, points):
+		margin = 5 * self.default_path_width + 1 # miter joins stick out beyond line width
+		xs = [_x for (_x, _y) in points]
+		ys = [_y for (_x, _y) in points]
+		return min(xs) - margin, min(ys) - margin, max(xs) - min(xs) + 2 * margin, max(ys) - min(ys) + 2 * margin
+	
 	def animation(self, freq):
 		if freq and not self.animation_freq:
-			self.animation_timer = glib.timeout_add(1000 / freq, self.handle_animation)
+			self.animation_timer = glib.timeout_add(1000 / freq, profiled(self.handle_animation))
 			self.animation_freq = freq
 		elif freq and self.animation_freq:
 			gobject.source_remove(self.animation_timer)
-			self.animation_timer = glib.timeout_add(1000 / freq, self.handle_animation)
+			self.animation_timer = glib.timeout_add(1000 / freq, profiled(self.handle_animation))
 			self.animation_freq = freq
 		elif not freq and self.animation_freq:
 			gobject.source_remove(self.animation_timer)
@@ -178,12 +213,15 @@ class GameWidget(gtk.DrawingArea):
 		self.terrain_x_redrawn = 0
 		self.terrain_y_redrawn = 0
 		self.terrain_scrolling = True
+		self.pan_velocity = 0, 0
+		self.pan_time = monotonic()
 	
 	def continue_terrain_scroll(self):
 		assert self.terrain_scrolling
 		
 		dx = self.pointer_secondary_x - self.pointer_primary_x
 		dy = self.pointer_secondary_y - self.pointer_primary_y
+		self.track_pan(self.terrain_x_orig + dx - self.terrain_x, self.terrain_y_orig + dy - self.terrain_y)
 		self.terrain_x = self.terrain_x_orig + dx
 		self.terrain_y = self.terrain_y_orig + dy
 		
@@ -207,38 +245,85 @@ class GameWidget(gtk.DrawingArea):
 		del self.terrain_y_redrawn
 		self.terrain_scrolling = False
 	
+	def track_pan(self, dx, dy):
+		"Update smoothed pan velocity (screen pixels per second) with the latest movement."
+		now = monotonic()
+		dt = now - self.pan_time
+		if dt <= 0:
+			return
+		k = min(dt / 0.1, 1)
+		vx, vy = self.pan_velocity
+		self.pan_velocity = vx + (dx / dt - vx) * k, vy + (dy / dt - vy) * k
+		self.pan_time = now
+		self.schedule_prefetch()
+		self.track_interaction()
+	
+	def track_zoom(self, factor):
+		self.zoom_direction = (factor > 1) - (factor < 1)
+		self.zoom_time = monotonic()
+		self.schedule_prefetch()
+		self.track_interaction()
+	
+	def track_interaction(self):
+		"The view is moving: render at interaction quality until input is idle for `refine_delay`."
+		self.interacting = True
+		self.interaction_time = monotonic()
+		if self.refine_timer is None:
+			self.refine_timer = glib.timeout_add(round(self.refine_delay * 1000), profiled(self.handle_refine))
+	
+	def predicted_motion(self):
+		"Pan velocity and zoom direction (1 out, -1 in), if the view moved recently, otherwise zeros."
+		now = monotonic()
+		velocity = self.pan_velocity if now - self.pan_time < self.prediction_timeout else (0, 0)
+		zoom = self.zoom_direction if now - self.zoom_time < self.prediction_timeout else 0
+		return velocity, zoom
+	
+	def schedule_prefetch(self):
+		if not self.prefetch_event:
+			self.prefetch_event = True
+			glib.idle_add(profiled(self.handle_prefetch), priority=glib.PRIORITY_LOW)
+	
+	def prefetch(self):
+		"Load something the view is about to need. Called when idle after the view moved, returns True to be called again."
+		return False
+	
+	def refine(self):
+		"Input stopped, redraw what was drawn at interaction quality."
+		self.invalidate('render_grid')
+	
 	def begin_menu_action(self):
 		assert not self.menu_showing
 		self.menu_showing = True
-		self.invalidate('render_menu')
+		self.invalidate_area(self.menu_area(), 'render_menu')
 	
 	def continue_menu_action(self):
 		assert self.menu_showing
-		self.invalidate('render_menu')
+		self.invalidate_area(self.menu_area(), 'render_menu')
 	
 	def end_menu_action(self):
 		assert self.menu_showing
 		self.menu_showing = False
-		self.invalidate('render_menu')
+		self.invalidate_area(self.menu_area(), 'render_menu')
 		self.select_action()
 	
 	def begin_path_follow(self):
 		assert not self.path_points
 		self.path_points.append((self.pointer_secondary_x, self.pointer_secondary_y))
-		self.invalidate('render_path')
+		self.invalidate_area(self.path_area(self.path_points), 'render_path')
 	
 	def continue_path_follow(self):
 		assert self.path_points
 		self.path_points.append((self.pointer_secondary_x, self.pointer_secondary_y))
-		self.invalidate('render_path')
+		self.invalidate_area(self.path_area(self.path_points[-2:]), 'render_path')
 	
 	def end_path_follow(self):
 		assert self.path_points
 		self.path_points.append((self.pointer_secondary_x, self.pointer_secondary_y))
-		self.invalidate('render_path')
+		area = self.path_area(self.path_points)
+		self.invalidate_area(area, 'render_path')
 		self.path_ready()
 		self.path_points.clear()
-		self.invalidate('render_path')
+		self.invalidate_area(area, 'render_path')
 	
 	def select_action(self):
 		dx = self.pointer_secondary_x - self.pointer_primary_x
@@ -260,9 +345,12 @@ class GameWidget(gtk.DrawingArea):
 	def execute_action(self, n):
 		print("menu action:", n)
 	
+	def pointer_moved(self, x, y):
+		pass
+	
 	def path_ready(self):
 		print("path_ready", len(self.path_points))
-		self.invalidate('render_path')
+		self.invalidate_area(self.path_area(self.path_points), 'render_path')
 	
 	@surface
 	def render_path(self):
@@ -467,6 +555,10 @@ class GameWidget(gtk.DrawingArea):
 	def draw_animations(self, ctx):
 		pass
 	
+	def draw_overlays(self, ctx):
+		"Draw widgets in screen coordinates, above the terrain and below the menu."
+		pass
+	
 	def handle_configure_event(self, drawingarea, event):
 		rect = self.get_allocation()
 		self.screen_width = rect.width
@@ -476,11 +568,16 @@ class GameWidget(gtk.DrawingArea):
 		self.invalidate('render_grid', 'render_items', 'render_background')
 	
 	def handle_draw(self, drawingarea, ctx):
+		"Paints only the damaged rectangles. Layers should be image surfaces, so painting them through a small clip is cheap."
+		
 		clip_rectangles = ctx.copy_clip_rectangle_list()
 		if len(clip_rectangles) == 1 and clip_rectangles[0] == cairo.Rectangle(0, 0, self.screen_width, self.screen_height):
 			fullscreen_event = True
 		else:
 			fullscreen_event = False
+			for rect in clip_rectangles:
+				ctx.rectangle(rect.x, rect.y, rect.width, rect.height)
+			ctx.clip()
 		
 		if self.x11_fixes:
 			ctx.set_source_surface(self.render_background())
@@ -512,6 +609,10 @@ class GameWidget(gtk.DrawingArea):
 			ctx.paint()	
 			ctx.restore()
 		
+		ctx.save()
+		self.draw_overlays(ctx)
+		ctx.restore()
+		
 		if self.menu_showing:
 			ctx.save()
 			ctx.set_source_surface(self.render_menu(), self.pointer_primary_x, self.pointer_primary_y)
@@ -590,6 +691,8 @@ class GameWidget(gtk.DrawingArea):
 			self.pointer_secondary_x = event.x
 			self.pointer_secondary_y = event.y
 			
+			self.pointer_moved(event.x, event.y)
+			
 			if self.terrain_scrolling:
 				self.continue_terrain_scroll()
 			
@@ -705,6 +808,18 @@ class GameWidget(gtk.DrawingArea):
 		elif event_type == gdk.EventType.TOUCH_CANCEL:
 			pass
 	
+	def handle_prefetch(self):
+		self.prefetch_event = self.prefetch()
+		return self.prefetch_event
+	
+	def handle_refine(self):
+		if monotonic() - self.interaction_time < self.refine_delay:
+			return True
+		self.refine_timer = None
+		self.interacting = False
+		self.refine()
+		return False
+	
 	def handle_scroll_event(self, drawingarea, event):
 		dy = event.get_scroll_deltas().delta_y
 		x = event.x
@@ -722,6 +837,7 @@ class GameWidget(gtk.DrawingArea):
 		self.terrain_x = -(event.x - self.terrain_x - self.screen_width / 2) / factor - self.screen_width / 2 + event.x
 		self.terrain_y = -(event.y - self.terrain_y - self.screen_height / 2) / factor - self.screen_height / 2 + event.y
 		self.terrain_scale = scale
+		self.track_zoom(factor)
 		#print("terrain_scale =", scale)
 		self.recalculate_viewport()
 		self.invalidate('render_grid', 'render_items')
@@ -10,8 +10,10 @@ Data: https://figshare.com/articles/dataset/LateQuaternary_Environment_nc/122933
 License: CC BY 4.0 https://creativecommons.org/licenses/by/4.0/
 """
 
-#import numpy as np
+import numpy as np
 import netCDF4 as nc4
+import json
+import os
 from math import ceil, isnan, pi
 from itertools import product
 import cairo
@@ -19,6 +21,9 @@ from os import mkdir
 from random import choice
 from multiprocessing import Pool
 
+from biome_data import BiomeCube
+from shards import parse_shard, shard_items, write_manifest, read_manifests, merge_files
+
 
 colors = [
 	(0.4, 0.4, 0.0), # shore
@@ -63,6 +68,40 @@ colors = [
 ]
 
 
+# BIOME4 classification
+names = [
+	"Unclassified",
+	"Tropical evergreen forest",
+	"Tropical semi-deciduous forest",
+	"Tropical deciduous forest/woodland",
+	"Temperate deciduous forest",
+	"Temperate conifer forest",
+	"Warm mixed forest",
+	"Cool mixed forest",
+	"Cool conifer forest",
+	"Cold mixed forest",
+	"Evergreen taiga/montane forest",
+	"Deciduous taiga/montane forest",
+	"Tropical savanna",
+	"Tropical xerophytic shrubland",
+	"Temperate xerophytic shrubland",
+	"Temperate sclerophyll woodland",
+	"Temperate broadleaved savanna",
+	"Open conifer woodland",
+	"Boreal parkland",
+	"Tropical grassland",
+	"Temperate grassland",
+	"Desert",
+	"Steppe tundra",
+	"Shrub tundra",
+	"Dwarf shrub tundra",
+	"Prostrate shrub tundra",
+	"Cushion-forb lichen moss tundra",
+	"Barren",
+	"Land ice"
+]
+
+
 data_file = 'data/LateQuaternary_Environment.nc'
 output_dir = 'biome'
 
@@ -116,10 +155,10 @@ def solve_maze(sx, sy, points, stick, o=None):
 	return solution
 
 
-def create_map(year, biome_points, lon, lat):
+def create_map(year, biome_points, lon, lat, output_dir=output_dir):
 	print(year)
 	
-	surface = cairo.SVGSurface(f'biome/{year}.svg', 720, 360)
+	surface = cairo.SVGSurface(f'{output_dir}/{year}.svg', 720, 360)
 	ctx = cairo.Context(surface)
 	
 	ctx.set_line_width(1)
@@ -242,8 +281,181 @@ def create_map(year, biome_points, lon, lat):
 	surface.flush()
 
 
+def changed_tiles(before, after, tile_cells=30):
+	"Tiles where the biome class of any cell differs between two epochs, as a boolean array (south to north, west to east)."
+	changed = ~((before == after) | (np.isnan(before) & np.isnan(after)))
+	
+	# Traced outlines and point gradients reach one cell into the neighbours. Longitude wraps around the antimeridian, latitude does not.
+	grown = changed.copy()
+	grown[1:, :] |= changed[:-1, :]
+	grown[:-1, :] |= changed[1:, :]
+	grown = grown | np.roll(grown, 1, axis=1) | np.roll(grown, -1, axis=1)
+	
+	lat, lon = grown.shape
+	return grown.reshape(lat // tile_cells, tile_cells, lon // tile_cells, tile_cells).any(axis=(1, 3))
+
+
+def biome_grid(biome, year_idx):
+	"Biome classes of one epoch as float array, NaN where there is no data."
+	return np.ma.filled(biome[year_idx].astype(np.float32), np.nan)
+
+
+def write_changes(years, biome, tile_degrees=15, output_dir=output_dir):
+	"For each pair of consecutive epochs, list south-west corners of the tiles whose biome changed."
+	
+	order = sorted(range(len(years)), key=lambda _n: years[_n])
+	tile_cells = tile_degrees * 2 # 0.5 degree grid
+	
+	changes = []
+	before = None
+	for year_idx in order:
+		after = biome_grid(biome, year_idx)
+		if before is not None:
+			tiles = changed_tiles(before, after, tile_cells)
+			changes.append([[int(-180 + _x * tile_degrees), int(-90 + _y * tile_degrees)] for (_y, _x) in zip(*np.nonzero(tiles))])
+		before = after
+	
+	with open(f'{output_dir}/changes.json', 'w') as fd:
+		json.dump({'tile_degrees': tile_degrees, 'years': [int(years[_n]) for _n in order], 'changes': changes}, fd)
+
+
+nodata = 255
+
+
+def write_cube(years, biome, output_dir=output_dir):
+	"""
+	All epochs as one memory-mappable uint8 array of class indices, time x lat x lon, oldest epoch first, north up.
+	Years and palette go to `index.json`, cells without data are `nodata`.
+	"""
+	
+	order = sorted(range(len(years)), key=lambda _n: years[_n])
+	lat, lon = biome.shape[1:]
+	
+	cube = np.lib.format.open_memmap(f'{output_dir}/biome.npy.tmp', mode='w+', dtype=np.uint8, shape=(len(order), lat, lon))
+	for n, year_idx in enumerate(order):
+		grid = biome_grid(biome, year_idx)
+		cube[n] = np.where(np.isnan(grid), nodata, grid).astype(np.uint8)[::-1]
+	cube.flush()
+	del cube
+	os.replace(f'{output_dir}/biome.npy.tmp', f'{output_dir}/biome.npy')
+	
+	with open(f'{output_dir}/index.json', 'w') as fd:
+		json.dump({'years': [int(years[_n]) for _n in order], 'palette': colors, 'names': names, 'nodata': nodata}, fd, indent=1)
+
+
+def majority(classes, factor):
+	"Most common class in every block of factor x factor cells."
+	if factor == 1:
+		return classes
+	rows, cols = classes.shape
+	blocks = classes.reshape(rows // factor, factor, cols // factor, factor).swapaxes(1, 2)
+	best = np.zeros((rows // factor, cols // factor), dtype=classes.dtype)
+	best_count = np.zeros(best.shape, dtype=np.int32)
+	for n in np.unique(classes):
+		count = (blocks == n).sum(axis=(2, 3))
+		better = count > best_count
+		best[better] = n
+		best_count[better] = count[better]
+	return best
+
+
+def block_rects(block):
+	"Cover cells of the block with rectangles of one class: runs along rows, merged with the same runs in the following rows."
+	rects = []
+	above = {}
+	for r, row in enumerate(block):
+		edges = np.flatnonzero(np.diff(row)) + 1
+		runs = {}
+		for a, b in zip(np.concatenate([[0], edges]), np.concatenate([edges, [len(row)]])):
+			n = int(row[a])
+			if n == nodata:
+				continue
+			try:
+				rect = above[a, b, n]
+			except KeyError:
+				rect = [n, int(a), r, int(b - a), 0]
+				rects.append(rect)
+			rect[4] += 1
+			runs[a, b, n] = rect
+		above = runs
+	return rects
+
+
+def write_vector_tiles(tile_degrees=15, factors=(1, 2, 3, 5), years=None, output_dir=output_dir):
+	"Classes of every map tile as rectangles, simplified by majority of f x f cells for each factor `f`, one file per epoch. All epochs of the cube by default."
+	
+	cube = BiomeCube(output_dir)
+	tile_cells = round(tile_degrees * cube.cells_per_degree)
+	factors = [_f for _f in factors if tile_cells % _f == 0]
+	
+	try:
+		mkdir(f'{output_dir}/tiles')
+	except FileExistsError:
+		pass
+	
+	if years is None:
+		years = cube.years
+	
+	for year in years:
+		classes = np.asarray(cube.classes(year))
+		arrays = {}
+		for f in factors:
+			simplified = majority(classes, f)
+			cells = tile_cells // f
+			tiles = [block_rects(simplified[_r:_r + cells, _c:_c + cells]) for _r in range(0, simplified.shape[0], cells) for _c in range(0, simplified.shape[1], cells)]
+			arrays[f'L{f}'] = np.array([_rect for _rects in tiles for _rect in _rects], dtype=np.int16).reshape(-1, 5)
+			arrays[f'L{f}_offsets'] = np.cumsum([0] + [len(_rects) for _rects in tiles]).astype(np.int32)
+		with open(f'{output_dir}/tiles/{year}.npz.tmp', 'wb') as fd:
+			np.savez_compressed(fd, **arrays)
+		os.replace(f'{output_dir}/tiles/{year}.npz.tmp', f'{output_dir}/tiles/{year}.npz')
+	
+	with open(f'{output_dir}/tiles/index.json', 'w') as fd:
+		json.dump({'tile_degrees': tile_degrees, 'tile_cells': tile_cells, 'factors': factors, 'years': list(years)}, fd, indent=1)
+
+
+def merge_bundles(bundles, output_dir=output_dir):
+	"Assemble maps built by shards, checking that every epoch of the cube has its map and vector tiles."
+	manifests = read_manifests(bundles)
+	os.makedirs(f'{output_dir}/tiles', exist_ok=True)
+	merge_files(bundles, manifests, output_dir, skip={'tiles/index.json'})
+	
+	tile_index = None
+	years = set()
+	for bundle, manifest in zip(bundles, manifests):
+		with open(f'{bundle}/tiles/index.json') as fd:
+			index = json.load(fd)
+		shard_years = index.pop('years')
+		if sorted(shard_years) != sorted(manifest['items']):
+			raise ValueError(f"Vector tile index of bundle {bundle} does not match its shard epochs")
+		years.update(shard_years)
+		if tile_index is not None and index != tile_index:
+			raise ValueError(f"Bundle {bundle} has vector tiles of different geometry")
+		tile_index = index
+	
+	all_years = BiomeCube(output_dir).years
+	missing = [_year for _year in all_years if not (os.path.exists(f'{output_dir}/{_year}.svg') and os.path.exists(f'{output_dir}/tiles/{_year}.npz'))]
+	if missing or years != set(all_years):
+		raise ValueError(f"Epochs missing from the bundles: {missing or sorted(set(all_years) - years)}")
+	
+	tile_index['years'] = all_years
+	with open(f'{output_dir}/tiles/index.json', 'w') as fd:
+		json.dump(tile_index, fd, indent=1)
+	print(f"merged {len(bundles)} bundles, {len(all_years)} epochs")
+
 
 if __name__ == '__main__':	
+	import argparse
+	
+	parser = argparse.ArgumentParser(description="Generate biome maps.")
+	parser.add_argument('--output-dir', default=output_dir)
+	parser.add_argument('--shard', metavar='K/N', help="draw maps of every N-th epoch from K-th on, into a bundle for --merge")
+	parser.add_argument('--merge', metavar='BUNDLE', nargs='+', help="assemble maps in output directory from bundles of all shards")
+	args = parser.parse_args()
+	
+	if args.merge:
+		merge_bundles(args.merge, args.output_dir)
+		raise SystemExit
+	
 	nc = nc4.Dataset(data_file, 'r')
 	longitude   = nc.variables['longitude'][...]
 	latitude    = nc.variables['latitude'][...]
@@ -253,13 +465,26 @@ if __name__ == '__main__':
 	biome       = nc.variables['biome']
 	
 	try:
-		mkdir(output_dir)
+		mkdir(args.output_dir)
 	except FileExistsError:
 		pass
 	
 	lon = longitude.shape[0]
 	lat = latitude.shape[0]
 	
+	# Cube and changes are cheap, every shard writes them, merge checks they agree.
+	epochs = list(enumerate(years))
+	if args.shard:
+		shard = parse_shard(args.shard)
+		epochs = shard_items(epochs, shard)
+	
+	write_cube(years, biome, args.output_dir)
+	write_changes(years, biome, output_dir=args.output_dir)
+	write_vector_tiles(years=[int(_year) for (_year_idx, _year) in epochs], output_dir=args.output_dir)
+	
 	with Pool(8) as pool:
-		pool.starmap(create_map, ((year, biome[year_idx], lon, lat) for (year_idx, year) in enumerate(years)))
+		pool.starmap(create_map, ((year, biome[year_idx], lon, lat, args.output_dir) for (year_idx, year) in epochs))
+	
+	if args.shard:
+		write_manifest(args.output_dir, shard, [int(_year) for (_year_idx, _year) in epochs])
 
@@ -10,35 +10,82 @@ CRC806-Database, doi: 10.5880/SFB806.19.
 Paper: https://crc806db.uni-koeln.de/data/Z/Z2/Paleocoastlines_GIS_dataset.pdf
 Data: https://crc806db.uni-koeln.de/dataset/show/paleocoastlines-gis-dataset1462293239/
 
+Every sea level is written by a separate process into `coast/{level}.bin` (see `coastline_data.py`). Shapes are read one at a time,
+shapes of other sea levels or outside of the bounding box are skipped without reading their points.
 """
 
+import os
+import numpy as np
 import shapefile
-import cairo
+from multiprocessing import Pool
 
-sf = shapefile.Reader('data/Paleocoastlines.zip')
+from coastline_data import write_coastlines
 
-surfaces = []
-ctxx = {}
 
-for sr in sf.shapeRecords():
-	l = sr.record.as_dict()['Sea level']
+data_file = 'data/Paleocoastlines.zip'
+output_dir = 'coast'
+level_field = 'Sea level'
+
+
+def sea_levels(data_file):
+	"Sea level of every shape. Reads only the attribute table."
+	sf = shapefile.Reader(data_file)
 	try:
-		ctx = ctxx[l]
-	except KeyError:
-		surface = cairo.SVGSurface(f'coast/{l}.svg', 360 * 2, 180 * 2)
-		surfaces.append(surface)
-		ctx = cairo.Context(surface)
-		ctxx[l] = ctx
-	
-	ctx.set_source_rgb(0, 0, 1)
-	ctx.move_to(*sr.shape.points[0])
-	for x, y in sr.shape.points[1:]:
-		ctx.line_to(x, y)
-	ctx.close_path()
-	ctx.fill()
-	#print(sr.shape)
+		return [_record[0] for _record in sf.iterRecords(fields=[level_field])]
+	finally:
+		sf.close()
+
 
-for surface in surfaces:
-	surface.flush()
+def shape_rings(shape):
+	"Points of every part of the shape, as arrays n x 2."
+	points = np.asarray(shape.points, dtype=np.float32)
+	bounds = list(shape.parts) + [len(points)]
+	return [points[_a:_b] for (_a, _b) in zip(bounds[:-1], bounds[1:]) if _b - _a >= 2]
+
+
+def generate_level(level, indices, data_file=data_file, bbox=None, output_dir=output_dir):
+	"Write rings of the shapes with provided indices, all of one sea level. Returns number of rings written."
+	print("generate_level", level)
+	sf = shapefile.Reader(data_file)
+	rings = []
+	try:
+		for n in indices:
+			shape = sf.shape(n, bbox=bbox) # None if its bounding box is outside, points are not read then
+			if shape is not None:
+				rings.extend(shape_rings(shape))
+	finally:
+		sf.close()
+	
+	filename = f'{output_dir}/{level}.bin'
+	write_coastlines(filename + '.tmp', rings)
+	os.replace(filename + '.tmp', filename)
+	return len(rings)
 
 
+if __name__ == '__main__':
+	import argparse
+	
+	parser = argparse.ArgumentParser(description="Generate coastlines for different sea levels.")
+	parser.add_argument('data_file', nargs='?', default=data_file)
+	parser.add_argument('--bbox', metavar='W,S,E,N', help="only shapes intersecting this box")
+	parser.add_argument('--levels', metavar='L,L,...', help="only these sea levels")
+	parser.add_argument('--output-dir', default=output_dir)
+	parser.add_argument('--processes', type=int, default=8)
+	args = parser.parse_args()
+	
+	bbox = [float(_c) for _c in args.bbox.split(',')] if args.bbox else None
+	
+	shapes = {}
+	for n, level in enumerate(sea_levels(args.data_file)):
+		shapes.setdefault(level, []).append(n)
+	if args.levels:
+		wanted = set(args.levels.split(','))
+		shapes = {_level: _indices for (_level, _indices) in shapes.items() if str(_level) in wanted}
+	
+	os.makedirs(args.output_dir, exist_ok=True)
+	
+	with Pool(args.processes) as p:
+		counts = p.starmap(generate_level, ((_level, _indices, args.data_file, bbox, args.output_dir) for (_level, _indices) in shapes.items()))
+	
+	for level, count in zip(shapes, counts):
+		print(f"{level}: {count} rings")
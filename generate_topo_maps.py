@@ -3,62 +3,239 @@
 
 """
 Data: https://www.ncei.noaa.gov/products/etopo-global-relief-model
+
+Works with 60, 30 and 15 arc-second models. Every tile is processed in strips of rows, so memory use does not depend on resolution.
+
+Tiles are 16-bit greyscale PNGs of elevation in metres (see `color_ramp.py`), coloured by the viewer, so restyling needs no rebuild.
+They are stored by content: `objects/` holds every distinct image once, named by hash of its samples, and `index.json` maps tile names
+to objects. Flat tiles, all of one elevation, get no image at all, just the elevation in the index. Tiles that are only nearly flat keep
+their image, as any ramp or sea level may colour their elevations apart.
 """
 
 
-from geotiff import GeoTiff
 from itertools import product
-import cairo
+import numpy as np
+import hashlib
+import json
+import os
 from os import mkdir
-from math import atan, ceil, pi
+from math import ceil
 from multiprocessing import Pool
 
+from dem import DEM, convert_if_needed
+from png_writer import PNGWriter
+from color_ramp import elevation_samples, bias
+from shards import parse_shard, shard_items, write_manifest, read_manifests, merge_files
+
 
 data_file = 'data/ETOPO_2022_v1_60s_N90W180_bed.tif'
 output_dir = 'topo'
 
 
-etopo = GeoTiff(data_file)
+etopo = {}
 
-try:
-	mkdir(output_dir)
-except FileExistsError:
-	pass
+def open_etopo(array_file):
+	"Memory-mapped elevation array, opened once per process."
+	try:
+		return etopo[array_file]
+	except KeyError:
+		dem = etopo[array_file] = DEM(array_file)
+		return dem
 
 
 step = 15
+strip_rows = 256
+
+
+def tile_corners():
+	"South-west corners of all tiles, in the order they are built."
+	return list(product(range(-180, 180, step), range(-90, 90, step)))
+
+
+def pyramid_levels(pixels_per_degree, coarsest=7.5):
+	"Downscale factors, halving resolution until the coarsest level has about `coarsest` pixels per degree."
+	levels = [1]
+	while pixels_per_degree / (levels[-1] * 2) >= coarsest:
+		levels.append(levels[-1] * 2)
+	return levels
+
+
+def downsample(elevation):
+	"Average 2x2 blocks. Odd last row or column is averaged with itself."
+	rows, cols = elevation.shape
+	if rows % 2 or cols % 2:
+		elevation = np.pad(elevation, ((0, rows % 2), (0, cols % 2)), mode='edge')
+	return (elevation[0::2, 0::2] + elevation[0::2, 1::2] + elevation[1::2, 0::2] + elevation[1::2, 1::2]) / 4
+
+
+def tile_name(xa, ya, downscale):
+	return f'{xa:+}{ya:+}s{downscale}'
 
-def generate_map(xa, ya):
+
+def object_filename(output_dir, digest):
+	return f'{output_dir}/objects/{digest[:2]}/{digest}.png'
+
+
+class TileContent:
+	"Hash of the rows written so far and their range of elevation, to tell whether the tile is flat."
+	
+	def __init__(self, width, height):
+		self.width = width
+		self.height = height
+		self.hash = hashlib.sha1(f'{width}x{height}:elevation'.encode('ascii'))
+		self.low = 0xffff
+		self.high = 0
+	
+	def update(self, samples):
+		self.hash.update(samples.tobytes())
+		self.low = min(self.low, int(samples.min()))
+		self.high = max(self.high, int(samples.max()))
+	
+	def uniform(self):
+		"Whether all samples are of one elevation, so that the tile looks flat in every ramp."
+		return self.low == self.high
+	
+	def entry(self):
+		if self.uniform():
+			return {'size': [self.width, self.height], 'elevation': self.low - bias}
+		else:
+			return {'size': [self.width, self.height], 'object': self.hash.hexdigest(), 'encoding': 'elevation'}
+
+
+def generate_map(xa, ya, array_file, output_dir=output_dir):
+	"Write all levels of the tile into the object store. Returns index entries of the tile names."
 	print("generate_map", xa, ya)
-	box = etopo.read_box(((xa, ya), (xa + step, ya + step)))
-	xr, yr = box.shape
-	
-	for downscale in [1, 2, 4, 8]:
-		surface = cairo.ImageSurface(cairo.Format.RGB24, ceil(xr / downscale), ceil(yr / downscale))
-		ctx = cairo.Context(surface)
-		
-		for xb, row in enumerate(box):
-			for yb, value in enumerate(row):
-				if not (xb % downscale == 0 and yb % downscale == 0):
-					continue
-				
-				k = (atan(value / 1000) / (pi / 2)) / 2 + 1/2
-				if value >= 0:
-					rgb = 0.5, k, 0
-				else:
-					rgb = 0, k, 0.5
-				
-				ctx.set_source_rgb(*rgb)
-				ctx.rectangle(yb / downscale + 0.5, xb / downscale + 0.5, 1, 1)
-				ctx.fill()
-		
-		surface.flush()
-		surface.write_to_png(f'{output_dir}/{xa:+}{ya:+}s{downscale}.png')
+	box = open_etopo(array_file).box(xa, ya, step, step)
+	levels = pyramid_levels(open_etopo(array_file).pixels_per_degree)
+	rows, cols = box.shape
+	
+	# Strip height divisible by every downscale factor, so each level gets whole rows from every strip but the last.
+	strip = max(strip_rows // levels[-1], 1) * levels[-1]
+	
+	temp_filenames = [f'{output_dir}/{tile_name(xa, ya, _downscale)}.png.tmp' for _downscale in levels]
+	writers = [PNGWriter(_filename, ceil(cols / _downscale), ceil(rows / _downscale), channels=1, bit_depth=16) for (_filename, _downscale) in zip(temp_filenames, levels)]
+	contents = [TileContent(ceil(cols / _downscale), ceil(rows / _downscale)) for _downscale in levels]
+	
+	for row in range(0, rows, strip):
+		level = box[row:row + strip].astype(np.float32)
+		for downscale, writer, content in zip(levels, writers, contents):
+			if downscale > 1:
+				level = downsample(level)
+			samples = elevation_samples(level)
+			writer.write_rows(samples)
+			content.update(samples)
+	
+	entries = {}
+	for downscale, temp_filename, writer, content in zip(levels, temp_filenames, writers, contents):
+		writer.close()
+		entry = entries[tile_name(xa, ya, downscale)] = content.entry()
+		if 'object' in entry:
+			filename = object_filename(output_dir, entry['object'])
+			if os.path.exists(filename):
+				os.remove(temp_filename) # same image stored by another tile
+			else:
+				os.makedirs(os.path.dirname(filename), exist_ok=True)
+				os.replace(temp_filename, filename)
+		else:
+			os.remove(temp_filename)
+	return entries
+
+
+def write_index(output_dir, entries):
+	"Tile names to objects or elevations, for the viewer."
+	with open(f'{output_dir}/index.json.tmp', 'w') as fd:
+		json.dump(entries, fd, indent=0, sort_keys=True)
+	os.replace(f'{output_dir}/index.json.tmp', f'{output_dir}/index.json')
+
+
+def merge_bundles(bundles, output_dir):
+	"Assemble tile stores built by shards into one, checking that every level of every tile is there."
+	manifests = read_manifests(bundles)
+	os.makedirs(output_dir, exist_ok=True)
+	merge_files(bundles, manifests, output_dir, skip={'index.json'})
+	
+	with open(f'{output_dir}/metadata.json') as fd:
+		levels = json.load(fd)['levels']
+	
+	index = {}
+	for bundle, manifest in zip(bundles, manifests):
+		with open(f'{bundle}/index.json') as fd:
+			entries = json.load(fd)
+		expected = {tile_name(_xa, _ya, _s) for (_xa, _ya) in manifest['items'] for _s in levels}
+		if entries.keys() != expected:
+			raise ValueError(f"Index of bundle {bundle} does not match its shard: {len(expected - entries.keys())} tiles missing, {len(entries.keys() - expected)} extra")
+		index.update(entries)
+	missing = sorted({tile_name(_xa, _ya, _s) for (_xa, _ya) in tile_corners() for _s in levels} - index.keys())
+	if missing:
+		raise ValueError(f"{len(missing)} tiles missing from the bundles, i.e. {', '.join(missing[:5])}")
+	for name, entry in index.items():
+		if 'object' in entry and not os.path.exists(object_filename(output_dir, entry['object'])):
+			raise ValueError(f"Image of tile {name} missing from the bundles")
+	
+	write_index(output_dir, index)
+	print(f"merged {len(bundles)} bundles, {len(index)} tiles")
+
+
+def write_metadata(output_dir, array_file):
+	"Tile geometry for the viewer."
+	pixels_per_degree = open_etopo(array_file).pixels_per_degree
+	metadata = {
+		'dem': array_file,
+		'pixels_per_degree': pixels_per_degree,
+		'tile_degrees': step,
+		'levels': pyramid_levels(pixels_per_degree)
+	}
+	with open(f'{output_dir}/metadata.json', 'w') as fd:
+		json.dump(metadata, fd, indent=1)
 
 
 if __name__ == '__main__':
-	with Pool(8) as p:
-		p.starmap(generate_map, ((xa, ya) for (xa, ya) in product(range(-180, 180, step), range(-90, 90, step))))
+	import argparse
+	
+	parser = argparse.ArgumentParser(description="Generate relief tiles.")
+	parser.add_argument('data_files', nargs='*', default=[data_file], help="ETOPO GeoTIFF: one global file (60 or 30 arc-second) or all tiles of the 15 arc-second model")
+	parser.add_argument('--output-dir', default=output_dir)
+	parser.add_argument('--processes', type=int, default=8)
+	parser.add_argument('--convert-only', action='store_true', help="only convert the elevation model, the viewer generates tiles when first shown")
+	parser.add_argument('--shard', metavar='K/N', help="build only every N-th tile from K-th on, into a bundle for --merge")
+	parser.add_argument('--merge', metavar='BUNDLE', nargs='+', help="assemble tile store in output directory from bundles of all shards")
+	args = parser.parse_args()
+	
+	if args.merge:
+		merge_bundles(args.merge, args.output_dir)
+		raise SystemExit
+	
+	shard = parse_shard(args.shard) if args.shard else None
+	
+	array_file = convert_if_needed(args.data_files)
+	
+	try:
+		mkdir(args.output_dir)
+	except FileExistsError:
+		pass
+	
+	write_metadata(args.output_dir, array_file)
+	if args.convert_only:
+		raise SystemExit
+	
+	corners = tile_corners()
+	if shard is not None:
+		corners = shard_items(corners, shard)
+	
+	with Pool(args.processes) as p:
+		tiles = p.starmap(generate_map, ((xa, ya, array_file, args.output_dir) for (xa, ya) in corners))
+	
+	index = {}
+	for entries in tiles:
+		index.update(entries)
+	write_index(args.output_dir, index)
+	
+	uniform = sum('elevation' in _entry for _entry in index.values())
+	objects = len(set(_entry['object'] for _entry in index.values() if 'object' in _entry))
+	print(f"{len(index)} tiles: {uniform} of one elevation, {objects} distinct images")
+	
+	if shard is not None:
+		write_manifest(args.output_dir, shard, [list(_corner) for _corner in corners])
 
 #if __name__ == '__main__':
 #	with Pool(8) as p:
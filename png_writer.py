@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+PNG writer that accepts the image a few rows at a time, so the whole image never has to be in memory.
+Also a reader of the 16-bit greyscale images it writes, decoded with zlib alone.
+"""
+
+import numpy as np
+import struct
+import zlib
+
+
+class PNGWriter:
+	color_types = {1: 0, 3: 2, 4: 6} # channels -> PNG colour type
+
+	def __init__(self, filename, width, height, channels=3, bit_depth=8, level=6):
+		self.file = open(filename, 'wb')
+		self.width = width
+		self.height = height
+		self.channels = channels
+		self.bit_depth = bit_depth
+		self.rows_written = 0
+		self.compressor = zlib.compressobj(level)
+		self.pending = []
+		self.pending_size = 0
+
+		self.file.write(b'\x89PNG\r\n\x1a\n')
+		self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, bit_depth, self.color_types[channels], 0, 0, 0))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		if args[0] is None:
+			self.close()
+		else:
+			self.file.close()
+
+	def write_chunk(self, kind, data):
+		self.file.write(struct.pack('>I', len(data)))
+		self.file.write(kind)
+		self.file.write(data)
+		self.file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(kind))))
+
+	def write_rows(self, rows):
+		"Append rows of shape (n, width, channels), uint8 for 8-bit and uint16 for 16-bit images."
+		rows = np.asarray(rows)
+		n = rows.shape[0]
+		if self.rows_written + n > self.height:
+			raise ValueError("Too many rows.")
+
+		if self.bit_depth == 16:
+			rows = rows.astype('>u2')
+		else:
+			rows = rows.astype(np.uint8, copy=False)
+		raw = np.zeros((n, 1 + self.width * self.channels * self.bit_depth // 8), dtype=np.uint8) # filter type 0 in front of every row
+		raw[:, 1:] = rows.reshape(n, -1).view(np.uint8)
+
+		data = self.compressor.compress(raw.tobytes())
+		if data:
+			self.pending.append(data)
+			self.pending_size += len(data)
+		if self.pending_size >= 1 << 18:
+			self.flush_pending()
+		self.rows_written += n
+
+	def flush_pending(self):
+		if self.pending:
+			self.write_chunk(b'IDAT', b''.join(self.pending))
+		self.pending.clear()
+		self.pending_size = 0
+
+	def close(self):
+		if self.rows_written != self.height:
+			raise ValueError(f"Expected {self.height} rows, got {self.rows_written}.")
+		self.pending.append(self.compressor.flush())
+		self.flush_pending()
+		self.write_chunk(b'IEND', b'')
+		self.file.close()
+
+
+def read_gray16(filename):
+	"Samples of a 16-bit greyscale PNG written by `PNGWriter`, as uint16 array. Only rows with filter type 0 are supported."
+	with open(filename, 'rb') as fd:
+		data = memoryview(fd.read())
+	if data[:8] != b'\x89PNG\r\n\x1a\n':
+		raise ValueError(f"Not a PNG file: {filename}")
+
+	pos = 8
+	idat = []
+	header = None
+	while pos < len(data):
+		length, = struct.unpack('>I', data[pos:pos + 4])
+		kind = bytes(data[pos + 4:pos + 8])
+		if kind == b'IHDR':
+			header = struct.unpack('>IIBBBBB', data[pos + 8:pos + 8 + length])
+		elif kind == b'IDAT':
+			idat.append(data[pos + 8:pos + 8 + length])
+		elif kind == b'IEND':
+			break
+		pos += 12 + length
+
+	width, height, bit_depth, color_type, compression, filter_method, interlace = header
+	if (bit_depth, color_type, interlace) != (16, 0, 0):
+		raise ValueError(f"Not a 16-bit greyscale image: {filename}")
+
+	raw = np.frombuffer(zlib.decompress(b''.join(idat)), dtype=np.uint8).reshape(height, 1 + 2 * width)
+	if raw[:, 0].any():
+		raise ValueError(f"Filtered rows are not supported: {filename}")
+	return raw[:, 1:].copy().view('>u2').astype(np.uint16)
@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+Opt-in profiling of rendering methods and input handlers, for finding slowdowns without patching the code.
+Enabled by the environment variable `CHRONOMAPS_PROFILE=directory` or by `start(directory)`.
+When the process exits, a report is written to the directory: cProfile statistics sorted by cumulative time,
+time and allocated bytes of every wrapped method, and allocation sites that grew during the session (tracemalloc).
+Disabled, a wrapped method costs one global lookup per call.
+"""
+
+import atexit
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+
+session = None
+
+
+class Session:
+	def __init__(self, directory):
+		self.directory = directory
+		self.started = time.time()
+		self.profile = cProfile.Profile()
+		self.main_thread = threading.main_thread()
+		self.depth = 0
+		self.lock = threading.Lock()
+		self.calls = defaultdict(lambda: [0, 0.0, 0, 0]) # calls, seconds, net bytes, peak bytes
+		tracemalloc.start()
+		self.snapshot = tracemalloc.take_snapshot()
+	
+	def call(self, name, function, args, kwargs):
+		outermost = threading.current_thread() is self.main_thread and self.depth == 0
+		if threading.current_thread() is self.main_thread:
+			self.depth += 1
+		if outermost:
+			tracemalloc.reset_peak()
+			self.profile.enable()
+		
+		memory_before = tracemalloc.get_traced_memory()[0]
+		start = time.perf_counter()
+		try:
+			return function(*args, **kwargs)
+		finally:
+			elapsed = time.perf_counter() - start
+			memory_after, memory_peak = tracemalloc.get_traced_memory()
+			if outermost:
+				self.profile.disable()
+			if threading.current_thread() is self.main_thread:
+				self.depth -= 1
+			with self.lock:
+				record = self.calls[name]
+				record[0] += 1
+				record[1] += elapsed
+				record[2] += memory_after - memory_before
+				if outermost:
+					record[3] = max(record[3], memory_peak - memory_before)
+	
+	def report(self):
+		"Text of the report."
+		out = io.StringIO()
+		duration = time.time() - self.started
+		print(f"ChronoMaps profile, pid {os.getpid()}, {duration:.1f}s", file=out)
+		
+		print("\n== wrapped methods by total time ==", file=out)
+		self.print_calls(out, key=lambda _item: _item[1][1])
+		print("\n== wrapped methods by allocated bytes ==", file=out)
+		self.print_calls(out, key=lambda _item: _item[1][2])
+		
+		print("\n== cProfile, by cumulative time ==", file=out)
+		try:
+			pstats.Stats(self.profile, stream=out).sort_stats('cumulative').print_stats(60)
+		except TypeError:
+			print("no calls recorded", file=out)
+		
+		print("== allocation sites grown during the session ==", file=out)
+		for stat in tracemalloc.take_snapshot().compare_to(self.snapshot, 'lineno')[:40]:
+			print(stat, file=out)
+		
+		return out.getvalue()
+	
+	def print_calls(self, out, key):
+		print(f"{'calls':>8} {'seconds':>10} {'ms/call':>9} {'net bytes':>14} {'peak bytes':>14}  method", file=out)
+		with self.lock:
+			items = sorted(self.calls.items(), key=key, reverse=True)
+		for name, (calls, seconds, net, peak) in items:
+			print(f"{calls:8d} {seconds:10.3f} {1000 * seconds / calls:9.2f} {net:14d} {peak:14d}  {name}", file=out)
+	
+	def write(self):
+		os.makedirs(self.directory, exist_ok=True)
+		stem = os.path.join(self.directory, time.strftime('profile-%Y%m%d-%H%M%S', time.localtime(self.started)) + f'-{os.getpid()}')
+		with open(stem + '.txt', 'w') as f:
+			f.write(self.report())
+		try:
+			self.profile.dump_stats(stem + '.prof') # for snakeviz, gprof2dot...
+		except TypeError:
+			pass
+		return stem + '.txt'
+
+
+def start(directory):
+	"Profile the rest of this process, the report is written on exit."
+	global session
+	if session is None:
+		session = Session(directory)
+		atexit.register(stop)
+	return session
+
+
+def stop():
+	"Write report of the session and stop profiling. Returns the file name of the report."
+	global session
+	if session is None:
+		return None
+	current, session = session, None
+	filename = current.write()
+	tracemalloc.stop()
+	return filename
+
+
+def profiled(function, name=None):
+	"Wrap function or bound method so that its calls are recorded while profiling is enabled."
+	if name is None:
+		name = getattr(function, '__qualname__', repr(function))
+	
+	def wrapper(*args, **kwargs):
+		if session is None:
+			return function(*args, **kwargs)
+		return session.call(name, function, args, kwargs)
+	
+	wrapper.__name__ = getattr(function, '__name__', name)
+	wrapper.__qualname__ = name
+	wrapper.__doc__ = function.__doc__
+	return wrapper
+
+
+if os.environ.get('CHRONOMAPS_PROFILE'):
+	start(os.environ['CHRONOMAPS_PROFILE'])
@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+Map projections. Map units are degrees of the equator: one unit is as long as one degree of longitude at the equator,
+so every projection shows the same level of detail at the same scale. North is towards positive `v`.
+
+Projected map tiles are resampled from the equirectangular tiles through inverse lookup tables: for every pixel of the
+projected tile, which equirectangular tile and which point in it. Tables do not depend on the epoch, so they are computed
+once per tile and reused for every year.
+"""
+
+import numpy as np
+from math import pi, radians, tan
+
+
+R = 180 / pi # sphere radius in map units
+
+
+class Equirectangular:
+	title = "Equirectangular"
+	bounds = -180, -90, 180, 90
+	
+	def forward(self, lon, lat):
+		return np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+	
+	def inverse(self, u, v):
+		u = np.asarray(u, dtype=np.float64)
+		v = np.asarray(v, dtype=np.float64)
+		return u, v, (np.abs(u) <= 180) & (np.abs(v) <= 90)
+
+
+class EqualArea:
+	"Lambert cylindrical equal-area. Areas are true, so polar ice sheets are not inflated."
+	
+	title = "Equal-area"
+	bounds = -180, -R, 180, R
+	
+	def forward(self, lon, lat):
+		return np.asarray(lon, dtype=np.float64), R * np.sin(np.radians(lat))
+	
+	def inverse(self, u, v):
+		u = np.asarray(u, dtype=np.float64)
+		s = np.asarray(v, dtype=np.float64) / R
+		return u, np.degrees(np.arcsin(np.clip(s, -1, 1))), (np.abs(u) <= 180) & (np.abs(s) <= 1)
+
+
+class WebMercator:
+	title = "Web Mercator"
+	max_lat = 85.0511287798
+	bounds = -180, -180, 180, 180
+	
+	def forward(self, lon, lat):
+		lat = np.clip(lat, -self.max_lat, self.max_lat)
+		return np.asarray(lon, dtype=np.float64), R * np.log(np.tan(pi / 4 + np.radians(lat) / 2))
+	
+	def inverse(self, u, v):
+		u = np.asarray(u, dtype=np.float64)
+		v = np.asarray(v, dtype=np.float64)
+		return u, np.degrees(2 * np.arctan(np.exp(v / R)) - pi / 2), (np.abs(u) <= 180) & (np.abs(v) <= 180)
+
+
+class PolarStereographic:
+	"Conformal view of one hemisphere centered on the pole, down to `min_lat` from it."
+	
+	def __init__(self, north=True, min_lat=0):
+		self.sign = 1 if north else -1
+		self.title = "North polar stereographic" if north else "South polar stereographic"
+		self.max_rho = 2 * R * tan(pi / 4 - radians(min_lat) / 2)
+		self.bounds = -self.max_rho, -self.max_rho, self.max_rho, self.max_rho
+	
+	def forward(self, lon, lat):
+		lam = np.radians(lon)
+		rho = 2 * R * np.tan(pi / 4 - self.sign * np.radians(lat) / 2)
+		return rho * np.sin(lam), -self.sign * rho * np.cos(lam)
+	
+	def inverse(self, u, v):
+		u = np.asarray(u, dtype=np.float64)
+		v = np.asarray(v, dtype=np.float64)
+		rho = np.hypot(u, v)
+		lat = self.sign * np.degrees(pi / 2 - 2 * np.arctan(rho / (2 * R)))
+		lon = np.degrees(np.arctan2(u, -self.sign * v))
+		return lon, lat, rho <= self.max_rho
+
+
+projections = {
+	'equirectangular': Equirectangular(),
+	'equal-area': EqualArea(),
+	'web-mercator': WebMercator(),
+	'north-polar': PolarStereographic(north=True),
+	'south-polar': PolarStereographic(north=False)
+}
+
+
+class InverseLUT:
+	"""
+	Source of every pixel of one projected tile: pixels are grouped by the equirectangular tile they come from, with their
+	position in it as a fraction of tile size, so the table works with any size of source images.
+	"""
+	
+	def __init__(self, projection, u0, v0, size, width, height, tile_step):
+		self.width = width
+		self.height = height
+		
+		cols, rows = np.meshgrid(np.arange(width) + 0.5, np.arange(height) + 0.5)
+		lon, lat, valid = projection.inverse(u0 + cols * size / width, v0 - rows * size / height)
+		lon = (lon + 180) % 360 - 180
+		lat = np.clip(lat, -90, np.nextafter(90, 0))
+		
+		index = np.flatnonzero(valid)
+		lon = lon.ravel()[index]
+		lat = lat.ravel()[index]
+		xa = (np.floor(lon / tile_step) * tile_step).astype(np.int32)
+		ya = (np.floor(lat / tile_step) * tile_step).astype(np.int32)
+		
+		self.groups = []
+		tile_ids = (xa + 180) * 1000 + (ya + 90)
+		order = np.argsort(tile_ids, kind='stable')
+		boundaries = np.flatnonzero(np.diff(tile_ids[order])) + 1
+		for group in np.split(order, boundaries):
+			if not len(group):
+				continue
+			x, y = int(xa[group[0]]), int(ya[group[0]])
+			fx = ((lon[group] - x) / tile_step).astype(np.float32)
+			fy = ((y + tile_step - lat[group]) / tile_step).astype(np.float32)
+			self.groups.append(((x, y), index[group].astype(np.int32), fx, fy))
+	
+	@property
+	def nbytes(self):
+		return sum(_index.nbytes + _fx.nbytes + _fy.nbytes for (_tile, _index, _fx, _fy) in self.groups)
+	
+	def source_tiles(self):
+		return [_tile for (_tile, _index, _fx, _fy) in self.groups]
+	
+	def resample(self, out, source, background=0xffffffff):
+		"Fill `out` (uint32 array height x width) from the source tiles. `source(x, y)` returns pixels of the tile as uint32 array."
+		flat = np.full(self.width * self.height, background, dtype=np.uint32)
+		for (x, y), index, fx, fy in self.groups:
+			pixels = source(x, y)
+			h, w = pixels.shape
+			cols = np.minimum((fx * w).astype(np.intp), w - 1)
+			rows = np.minimum((fy * h).astype(np.intp), h - 1)
+			flat[index] = pixels[rows, cols]
+		out[...] = flat.reshape(self.height, self.width)
@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+What lies at a point: elevation, biome class and its name. Reads memory-mapped arrays, no decoding.
+"""
+
+import numpy as np
+
+
+class PointQuery:
+	def __init__(self, dem=None, biome=None):
+		self.dem = dem
+		self.biome = biome
+	
+	def at(self, lon, lat, year):
+		"Elevation in meters, biome class and biome name at one point. Missing data is None."
+		elevation = float(self.dem.sample(lon, lat)) if self.dem is not None else None
+		if self.biome is not None and year in self.biome.years:
+			n = int(self.biome.sample(lon, lat, year))
+			return elevation, (n if n != self.biome.nodata else None), self.biome.name(n)
+		else:
+			return elevation, None, None
+	
+	def batch(self, lons, lats, year):
+		"Elevations and biome classes at arrays of points. No data is NaN elevation and class `biome.nodata`."
+		lons = np.asarray(lons, dtype=np.float64)
+		lats = np.asarray(lats, dtype=np.float64)
+		
+		if self.dem is not None:
+			elevations = self.dem.sample(lons, lats).astype(np.float32)
+		else:
+			elevations = np.full(lons.shape, np.nan, dtype=np.float32)
+		
+		if self.biome is not None and year in self.biome.years:
+			classes = self.biome.sample(lons, lats, year)
+		else:
+			classes = np.full(lons.shape, 255, dtype=np.uint8)
+		
+		return elevations, classes
+	
+	def names(self, classes):
+		"Biome names for an array of classes."
+		return [self.biome.name(int(_n)) for _n in np.ravel(classes)]
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+Builds split into shards, for running the generators on many machines.
+
+Shard `k/n` (k from 1 to n) takes every n-th item of the full list, starting at item k - 1, so neighbouring tiles or epochs
+(similar cost) go to different shards. Every shard writes an independent bundle directory with `shard.json`: the shard spec,
+its items and SHA-1 of every file. Merging checks that all shards of one build are there, that every file arrived intact
+and that files present in several bundles agree, then copies them into the final directory.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+
+def parse_shard(spec):
+	"Shard number and count from text `k/n`."
+	try:
+		k, n = (int(_x) for _x in spec.split('/'))
+	except ValueError:
+		raise ValueError(f"Shard must be k/n, got: {spec}")
+	if not 1 <= k <= n:
+		raise ValueError(f"Shard number must be between 1 and {n}, got: {k}")
+	return k, n
+
+
+def shard_items(items, shard):
+	"Items belonging to the shard, in the original order."
+	k, n = shard
+	return list(items)[k - 1::n]
+
+
+def file_hash(filename):
+	h = hashlib.sha1()
+	with open(filename, 'rb') as fd:
+		for block in iter(lambda: fd.read(1024**2), b''):
+			h.update(block)
+	return h.hexdigest()
+
+
+def write_manifest(directory, shard, items, extra=None):
+	"Describe the bundle: shard spec, items and hash of every file in the directory."
+	files = {str(_path.relative_to(directory)): file_hash(_path) for _path in sorted(Path(directory).rglob('*')) if _path.is_file() and _path.name != 'shard.json'}
+	manifest = {'shard': shard[0], 'of': shard[1], 'items': items, 'files': files}
+	if extra:
+		manifest.update(extra)
+	with open(f'{directory}/shard.json', 'w') as fd:
+		json.dump(manifest, fd, indent=1)
+	return manifest
+
+
+def read_manifests(bundles):
+	"Manifests of the bundles, checking that they are all shards of one build, each exactly once."
+	manifests = [json.loads(Path(_bundle, 'shard.json').read_text()) for _bundle in bundles]
+	if not manifests:
+		raise ValueError("No bundles to merge.")
+	
+	n = manifests[0]['of']
+	if any(_manifest['of'] != n for _manifest in manifests):
+		raise ValueError("Bundles are shards of builds split in different numbers of shards.")
+	numbers = sorted(_manifest['shard'] for _manifest in manifests)
+	if numbers != list(range(1, n + 1)):
+		raise ValueError(f"Expected shards 1 to {n}, got: {numbers}")
+	return manifests
+
+
+def merge_files(bundles, manifests, output_dir, skip=()):
+	"Copy files of all bundles into the output directory, verifying their hashes. Files in `skip` are verified too, but merged by the caller."
+	merged = {}
+	for bundle, manifest in zip(bundles, manifests):
+		for name in skip:
+			if name not in manifest['files']:
+				raise ValueError(f"File missing from the manifest of bundle {bundle}: {name}")
+		for name, digest in manifest['files'].items():
+			if file_hash(Path(bundle, name)) != digest:
+				raise ValueError(f"Corrupted file in bundle {bundle}: {name}")
+			if name in skip:
+				continue
+			if name in merged:
+				if merged[name] != digest:
+					raise ValueError(f"Bundles disagree on {name}")
+				continue
+			merged[name] = digest
+			
+			target = Path(output_dir, name)
+			if target.exists() and file_hash(target) == digest:
+				continue
+			target.parent.mkdir(parents=True, exist_ok=True)
+			shutil.copyfile(Path(bundle, name), str(target) + '.tmp')
+			os.replace(str(target) + '.tmp', target)
+	return merged
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+Caches of rendered tiles: bounded in memory, and persistent on disk, shared between sessions.
+"""
+
+import os
+from collections import OrderedDict
+from hashlib import sha1
+from pathlib import Path
+from tempfile import mkstemp
+from threading import Lock
+
+
+def file_identity(filename):
+	"Identity of a source file. Replacing or modifying the file changes its identity."
+	st = os.stat(filename)
+	return f'{Path(filename).resolve()}:{st.st_size}:{st.st_mtime_ns}'
+
+
+class DiskCache:
+	def __init__(self, directory, max_bytes=2 * 1024**3):
+		self.directory = Path(directory)
+		self.directory.mkdir(parents=True, exist_ok=True)
+		self.max_bytes = max_bytes
+		self.total_bytes = sum(_path.stat().st_size for _path in self.entries())
+	
+	def entries(self):
+		for path in self.directory.glob('??/*'):
+			if not path.name.startswith('.'):
+				yield path
+	
+	@staticmethod
+	def key(*parts):
+		return sha1('\0'.join(str(_part) for _part in parts).encode('utf-8')).hexdigest()
+	
+	def path(self, key, ext='png'):
+		return self.directory / key[:2] / f'{key}.{ext}'
+	
+	def get(self, key, ext='png'):
+		"Return path of the cached entry or None. Entry's mtime is bumped, so pruning is least-recently-used."
+		path = self.path(key, ext)
+		try:
+			os.utime(path)
+		except FileNotFoundError:
+			return None
+		return path
+	
+	def put(self, key, write, ext='png'):
+		"Call `write(filename)` on a temporary file, then atomically move it in place."
+		path = self.path(key, ext)
+		path.parent.mkdir(exist_ok=True)
+		fd, tmp = mkstemp(dir=path.parent, prefix='.', suffix='.tmp')
+		os.close(fd)
+		try:
+			write(tmp)
+			try:
+				self.total_bytes -= path.stat().st_size
+			except FileNotFoundError:
+				pass
+			os.replace(tmp, path)
+		except:
+			os.unlink(tmp)
+			raise
+		
+		self.total_bytes += path.stat().st_size
+		if self.total_bytes > self.max_bytes:
+			self.prune()
+		return path
+	
+	def prune(self, target=0.9):
+		entries = []
+		for path in self.entries():
+			try:
+				st = path.stat()
+			except FileNotFoundError:
+				continue
+			entries.append((st.st_mtime_ns, st.st_size, path))
+		entries.sort()
+		
+		total = sum(_size for (_mtime, _size, _path) in entries)
+		for mtime, size, path in entries:
+			if total <= self.max_bytes * target:
+				break
+			try:
+				path.unlink()
+			except FileNotFoundError:
+				pass
+			total -= size
+		
+		self.total_bytes = total
+
+
+class MemoryCache:
+	"Mapping used as `rendered_surface`, limited by total size of images in bytes. Least recently used entries are evicted first. Thread safe."
+	
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.total_bytes = 0
+		self.entries = OrderedDict()
+		self.lock = Lock()
+	
+	@staticmethod
+	def size_of(value):
+		if isinstance(value, tuple):
+			value = value[0]
+		if isinstance(value, bytes):
+			return len(value)
+		if hasattr(value, 'nbytes'): # arrays and lookup tables
+			return value.nbytes
+		try:
+			return value.get_stride() * value.get_height()
+		except AttributeError: # recording surfaces and other small objects
+			return 0
+	
+	def __len__(self):
+		return len(self.entries)
+	
+	def __contains__(self, key):
+		return key in self.entries
+	
+	def __getitem__(self, key):
+		with self.lock:
+			value, size = self.entries[key]
+			self.entries.move_to_end(key)
+			return value
+	
+	def __setitem__(self, key, value):
+		size = self.size_of(value)
+		with self.lock:
+			try:
+				old_value, old_size = self.entries.pop(key)
+				self.total_bytes -= old_size
+			except KeyError:
+				pass
+			self.entries[key] = value, size
+			self.total_bytes += size
+			while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+				old_key, (old_value, old_size) = self.entries.popitem(last=False)
+				self.total_bytes -= old_size
+	
+	def __delitem__(self, key):
+		with self.lock:
+			value, size = self.entries.pop(key)
+			self.total_bytes -= size
+	
+	def keys(self):
+		with self.lock:
+			return list(self.entries.keys())
@@ -0,0 +1,601 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+import gi
+gi.require_version('Gdk', '3.0')
+gi.require_version('Rsvg', '2.0')
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import Gdk, Rsvg, GdkPixbuf
+
+import cairo
+import json
+import math
+import multiprocessing
+import numpy as np
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock
+
+from biome_data import BiomeCube, BiomeTiles
+from projection import projections, InverseLUT
+from color_ramp import load_ramp, color_lut, bias
+from png_writer import read_gray16
+from contours import TileContours, levels_between, shelf_edge
+from dem import DEM, array_filename
+from game_widget import surface
+from tile_cache import DiskCache, MemoryCache, file_identity
+from generate_topo_maps import data_file, tile_name, object_filename, generate_map, pyramid_levels, write_index, write_metadata
+
+
+class TilePending(Exception):
+	"Topo tile is being generated in the background."
+
+
+class TileMissing(TilePending):
+	"Generation of the topo tile failed. It is not tried again in this session."
+
+
+class TileRenderer:
+	"Loads topo tiles and biome layers and composites them into map tiles. Does not depend on any widget."
+	
+	biome_imgs = 'biome', 'svg'
+	topo_imgs = 'topo', 'png'
+	
+	def __init__(self, cache_dir=None, memory_budget=1024**3, generate_workers=None):
+		self.rendered_surface = MemoryCache(memory_budget)
+		self.disk_cache = DiskCache(cache_dir) if cache_dir else None
+		self.biome_raster_scale = 4
+		self.wait_for_tiles = True # otherwise raise TilePending while missing tiles are generated
+		self.tile_ready_action = None # called from another thread with (x, y) of generated tile
+		self.tile_error_action = None # called from another thread with (x, y, error) when generation fails, once per tile
+		self.failed_tiles = {}
+		self.generate_workers = generate_workers
+		self.generate_pool = None
+		self.generating = {}
+		self.generate_lock = Lock()
+		self.present_tiles = set()
+		self.contour_spacing = 250 # metres between contours at full detail, more at coarser levels
+		self.inverse_luts = MemoryCache(256 * 1024**2)
+		self.set_color_ramp('relief')
+		self.load_metadata()
+		self.load_tile_index()
+		self.load_changes()
+		self.load_cube()
+		self.load_dem()
+	
+	def load_metadata(self):
+		"Tile geometry written by `generate_topo_maps.py`. Tiles made before it was written are 15 degrees, 4 levels."
+		topo_dir, topo_ext = self.topo_imgs
+		try:
+			metadata = json.loads(Path(topo_dir, 'metadata.json').read_text())
+		except FileNotFoundError:
+			metadata = self.dem_metadata()
+		self.pixels_per_degree = metadata.get('pixels_per_degree', 42)
+		self.tile_step = metadata.get('tile_degrees', 15)
+		self.topo_levels = metadata.get('levels', [1, 2, 4, 8])
+		self.dem_file = metadata.get('dem', array_filename(data_file))
+	
+	def dem_metadata(self):
+		"Tile geometry for tiles not generated yet, when there are no old tiles either."
+		topo_dir, topo_ext = self.topo_imgs
+		dem_file = array_filename(data_file)
+		if any(Path(topo_dir).glob('*.' + topo_ext)) or not os.path.exists(dem_file):
+			return {}
+		pixels_per_degree = DEM(dem_file).pixels_per_degree
+		return {'dem': dem_file, 'pixels_per_degree': pixels_per_degree, 'levels': pyramid_levels(pixels_per_degree)}
+	
+	def load_tile_index(self):
+		"Content-addressed tiles written by `generate_topo_maps.py`. Without the index, tiles are files named by their corner."
+		topo_dir, topo_ext = self.topo_imgs
+		try:
+			self.tile_index = json.loads(Path(topo_dir, 'index.json').read_text())
+		except FileNotFoundError:
+			self.tile_index = {}
+	
+	def load_dem(self):
+		"Memory-mapped elevation model, if converted."
+		try:
+			self.dem = DEM(self.dem_file)
+		except FileNotFoundError:
+			self.dem = None
+	
+	def load_pixbuf(self, filename, mime):
+		loader = GdkPixbuf.PixbufLoader.new_with_mime_type(mime)
+		loader.write(Path(filename).read_bytes())
+		loader.close()
+		pixbuf = loader.get_pixbuf()
+		image = Gdk.cairo_surface_create_from_pixbuf(pixbuf, 0, None)
+		width = pixbuf.get_width()
+		height = pixbuf.get_height()
+		return image, width, height
+	
+	def load_svg(self, filename):
+		rsvg = Rsvg.Handle.new_from_file(filename)
+		image = cairo.RecordingSurface(cairo.Content.COLOR_ALPHA, (0, 0, rsvg.props.width, rsvg.props.height))
+		ctx = cairo.Context(image)
+		
+		rect = Rsvg.Rectangle()
+		rect.width = rsvg.props.width
+		rect.height = rsvg.props.height
+		
+		rsvg.render_document(ctx, rect)
+		
+		width = rsvg.props.width
+		height = rsvg.props.height
+		return image, width, height
+	
+	def load_cached_png(self, key):
+		if self.disk_cache is None:
+			return None
+		path = self.disk_cache.get(key)
+		if path is None:
+			return None
+		image = cairo.ImageSurface.create_from_png(str(path))
+		return image, image.get_width(), image.get_height()
+	
+	def store_cached_png(self, key, image):
+		if self.disk_cache is not None:
+			self.disk_cache.put(key, image.write_to_png)
+	
+	@surface
+	def load_image(self, filename):
+		ext = filename.split('.')[-1]
+		if ext == 'png':
+			return self.load_pixbuf(filename, 'image/png')
+		elif ext == 'svg':
+			return self.load_svg(filename)
+		else:
+			raise NotImplementedError
+	
+	def load_cube(self):
+		"Biome classes of all epochs, if generated. Preferred over the traced SVG maps."
+		biome_dir, biome_ext = self.biome_imgs
+		try:
+			self.biome_cube = BiomeCube(biome_dir)
+		except FileNotFoundError:
+			self.biome_cube = None
+			self.biome_tiles = None
+			return
+		self.biome_lut = self.biome_cube.argb_lut()
+		try:
+			self.biome_tiles = BiomeTiles(biome_dir)
+		except FileNotFoundError:
+			self.biome_tiles = None
+	
+	def biome_years(self):
+		if self.biome_cube is not None:
+			return self.biome_cube.years
+		biome_dir, biome_ext = self.biome_imgs
+		return sorted(int(p.stem) for p in Path(biome_dir).iterdir() if p.suffix == '.' + biome_ext)
+	
+	def biome_epoch(self, year_bp):
+		"Biome map year to show for the provided number of years before present."
+		return min(_y for _y in self.biome_years() if _y >= -year_bp)
+	
+	def load_changes(self):
+		"Tiles changed between consecutive epochs, written by `generate_biome_maps.py`."
+		biome_dir, biome_ext = self.biome_imgs
+		self.change_years = []
+		self.tile_changes = []
+		self.tile_epochs = {}
+		try:
+			changes = json.loads(Path(biome_dir, 'changes.json').read_text())
+		except FileNotFoundError:
+			return
+		if changes['tile_degrees'] != self.tile_step:
+			return
+		self.change_years = changes['years']
+		self.tile_changes = [frozenset(tuple(_tile) for _tile in _changes) for _changes in changes['changes']]
+	
+	def changed_tiles(self, year_a, year_b):
+		"Tiles (by south-west corner) that look different in the two epochs, or None if not known."
+		try:
+			a = self.change_years.index(year_a)
+			b = self.change_years.index(year_b)
+		except ValueError:
+			return None
+		if a > b:
+			a, b = b, a
+		return frozenset().union(*self.tile_changes[a:b])
+	
+	def tile_epoch(self, x, y, year):
+		"Earliest epoch with the same biome in tile (x, y) as in `year`. Composites are shared by all epochs that look the same."
+		try:
+			return self.tile_epochs[x, y, year]
+		except KeyError:
+			pass
+		
+		try:
+			n = self.change_years.index(year)
+		except ValueError:
+			return year
+		while n > 0 and (x, y) not in self.tile_changes[n - 1]:
+			n -= 1
+		epoch = self.tile_epochs[x, y, year] = self.change_years[n]
+		return epoch
+	
+	def biome_filename(self, year):
+		biome_dir, biome_ext = self.biome_imgs
+		return f'{biome_dir}/{year}.{biome_ext}'
+	
+	def biome_identity(self, year):
+		"Identity of the biome layer source, for disk cache keys."
+		if self.biome_tiles is not None and year in self.biome_tiles.years:
+			return f'{file_identity(self.biome_cube.filename)}:{year}:tiles'
+		elif self.biome_cube is not None:
+			return f'{file_identity(self.biome_cube.filename)}:{year}'
+		else:
+			return f'{file_identity(self.biome_filename(year))}:{self.biome_raster_scale}'
+	
+	@surface
+	def load_biome(self, year):
+		"Biome layer: palette lookup of the class cube, or the SVG map rasterized at `biome_raster_scale` times its resolution."
+		
+		if self.biome_cube is not None:
+			classes = self.biome_cube.classes(year)
+			height, width = classes.shape
+			image = cairo.ImageSurface(cairo.Format.ARGB32, width, height)
+			data = np.ndarray(shape=(height, image.get_stride() // 4), dtype=np.uint32, buffer=image.get_data())
+			data[:, :width] = self.biome_lut[classes]
+			image.mark_dirty()
+			return image, width, height
+		
+		filename = self.biome_filename(year)
+		if self.disk_cache is not None:
+			key = self.disk_cache.key('biome', file_identity(filename), self.biome_raster_scale)
+			cached = self.load_cached_png(key)
+			if cached is not None:
+				return cached
+		
+		vector, vector_width, vector_height = self.load_image(filename)
+		width = math.ceil(vector_width * self.biome_raster_scale)
+		height = math.ceil(vector_height * self.biome_raster_scale)
+		image = cairo.ImageSurface(cairo.Format.ARGB32, width, height)
+		ctx = cairo.Context(image)
+		ctx.scale(width / vector_width, height / vector_height)
+		ctx.set_source_surface(vector)
+		ctx.paint()
+		image.flush()
+		
+		if self.disk_cache is not None:
+			self.store_cached_png(key, image)
+		return image, width, height
+	
+	def paint_biome_tile(self, ctx, x, y, year, width, height, alpha=0.5):
+		"Biome rectangles of the tile (x, y) on `width` x `height` pixels, simplified so that cells are not much smaller than pixels."
+		tiles = self.biome_tiles
+		f = tiles.factor(width / tiles.tile_cells)
+		rects = tiles.rects(year, x, y, f)
+		
+		ctx.save()
+		ctx.scale(width * f / tiles.tile_cells, height * f / tiles.tile_cells)
+		ctx.set_antialias(cairo.Antialias.NONE)
+		ctx.push_group()
+		for n in np.unique(rects[:, 0]):
+			ctx.set_source_rgb(*self.biome_cube.palette[n])
+			for _, column, row, w, h in rects[rects[:, 0] == n]:
+				ctx.rectangle(column, row, w, h)
+			ctx.fill()
+		ctx.pop_group_to_source()
+		ctx.paint_with_alpha(alpha)
+		ctx.restore()
+	
+	def tile_lod(self, s):
+		"Least detailed level that is still at least as detailed as the screen."
+		for level in self.topo_levels:
+			if s <= level:
+				return level
+		return self.topo_levels[-1]
+	
+	def tile_key(self, x, y, s):
+		"Normalized coordinates and level of detail of the tile at (x, y) for the provided scale."
+		if not -180 <= x < 180: x = (x + 180) % 360 - 180
+		if not -90 <= y < 90: y = (y + 90) % 180 - 90
+		return x, y, self.tile_lod(s)
+	
+	def topo_filename(self, x, y, s):
+		topo_dir, topo_ext = self.topo_imgs
+		try:
+			return object_filename(topo_dir, self.tile_index[tile_name(x, y, s)]['object'])
+		except KeyError:
+			return f'{topo_dir}/{tile_name(x, y, s)}.{topo_ext}'
+	
+	def topo_identity(self, x, y, s):
+		"Identifies contents of the topo tile, for the disk cache."
+		try:
+			entry = self.tile_index[tile_name(x, y, s)]
+		except KeyError:
+			return file_identity(self.topo_filename(x, y, s))
+		if 'color' in entry:
+			return tuple(entry['color'])
+		return entry.get('object', entry.get('elevation')), self.ramp_identity
+	
+	def tile_grid(self):
+		"Number of tile columns and rows covering the globe."
+		return 360 // self.tile_step, 180 // self.tile_step
+	
+	def require_tile(self, x, y, s):
+		"Make sure the topo tile exists. Missing tiles are generated from the elevation model, all levels at once, and stored for later sessions."
+		if (x, y, s) in self.present_tiles:
+			return
+		if tile_name(x, y, s) in self.tile_index or os.path.exists(self.topo_filename(x, y, s)):
+			self.present_tiles.add((x, y, s))
+			return
+		if self.dem is None:
+			raise FileNotFoundError(self.topo_filename(x, y, s))
+		
+		if (x, y) in self.failed_tiles:
+			if self.wait_for_tiles:
+				raise self.failed_tiles[x, y]
+			raise TileMissing(x, y)
+		
+		future = self.generate_tile(x, y)
+		if self.wait_for_tiles or future.done():
+			error = future.exception() # waits for the tile
+			if error is None:
+				self.add_tiles(future.result())
+				return
+			if self.wait_for_tiles:
+				raise error
+			raise TileMissing(x, y)
+		raise TilePending(x, y)
+	
+	def generate_tile(self, x, y):
+		"Schedule generation of the tile on the worker pool, once."
+		topo_dir, topo_ext = self.topo_imgs
+		with self.generate_lock:
+			try:
+				return self.generating[x, y]
+			except KeyError:
+				pass
+			
+			if self.generate_pool is None:
+				os.makedirs(topo_dir, exist_ok=True)
+				if not os.path.exists(f'{topo_dir}/metadata.json'):
+					write_metadata(topo_dir, self.dem_file)
+				if self.wait_for_tiles:
+					# Callers block anyway. Works in daemonic processes of frame export, which can not have children.
+					self.generate_pool = ThreadPoolExecutor(self.generate_workers)
+				else:
+					# Fork of a process with Gtk and render threads is unsafe.
+					self.generate_pool = ProcessPoolExecutor(self.generate_workers, mp_context=multiprocessing.get_context('spawn'))
+			
+			future = self.generating[x, y] = self.generate_pool.submit(generate_map, x, y, self.dem_file, topo_dir)
+		
+		future.add_done_callback(lambda _future: self.tile_generated(x, y, _future))
+		return future
+	
+	def tile_generated(self, x, y, future):
+		error = future.exception()
+		if error is None:
+			self.add_tiles(future.result()) # before forgetting the future, so the tile is not scheduled again
+		else:
+			self.failed_tiles[x, y] = error
+		with self.generate_lock:
+			del self.generating[x, y]
+		if error is None and self.tile_ready_action is not None:
+			self.tile_ready_action(x, y)
+		elif error is not None and self.tile_error_action is not None:
+			self.tile_error_action(x, y, error)
+	
+	def add_tiles(self, entries):
+		"Record generated tiles in the index, on disk too."
+		topo_dir, topo_ext = self.topo_imgs
+		with self.generate_lock:
+			if all(self.tile_index.get(_name) == _entry for (_name, _entry) in entries.items()):
+				return
+			self.tile_index.update(entries)
+			write_index(topo_dir, self.tile_index)
+	
+	def set_color_ramp(self, ramp, sea_level=0):
+		"Colour elevation tiles with the ramp from `color_ramp.py`, the coast at `sea_level` metres. Cached tiles in old colours are dropped."
+		self.color_lut = color_lut(load_ramp(ramp), sea_level)
+		self.ramp_identity = f'{ramp}:{sea_level}'
+		for key in self.rendered_surface.keys():
+			if key[0] in ('topo_image', 'composite_tile', 'projected_tile'):
+				try:
+					del self.rendered_surface[key]
+				except KeyError:
+					pass
+	
+	def ramp_color(self, elevation):
+		"Colour of the elevation in the current ramp, as cairo source."
+		pixel = int(self.color_lut[min(max(round(elevation) + bias, 0), 0xffff)])
+		return cairo.SolidPattern(((pixel >> 16) & 0xff) / 255, ((pixel >> 8) & 0xff) / 255, (pixel & 0xff) / 255)
+	
+	@surface
+	def load_samples(self, filename):
+		"Decoded elevation tile, kept apart from its colours so that restyling does not decode it again."
+		samples = read_gray16(filename)
+		return samples, samples.shape[1], samples.shape[0]
+	
+	@surface
+	def topo_image(self, filename):
+		"Elevation tile coloured through the lookup table of the ramp."
+		samples, width, height = self.load_samples(filename)
+		image = cairo.ImageSurface(cairo.Format.RGB24, width, height)
+		data = np.ndarray(shape=(height, image.get_stride() // 4), dtype=np.uint32, buffer=image.get_data())
+		data[:, :width] = self.color_lut[samples]
+		image.mark_dirty()
+		return image, width, height
+	
+	def get_tile(self, x, y, s):
+		"Source pattern of the topo tile and its size. Tiles of one colour are solid patterns, nothing is decoded."
+		x, y, s = self.tile_key(x, y, s)
+		entry = self.tile_index.get(tile_name(x, y, s), {})
+		if 'color' in entry:
+			r, g, b = entry['color']
+			width, height = entry['size']
+			return cairo.SolidPattern(r / 255, g / 255, b / 255), width, height
+		if 'elevation' in entry:
+			width, height = entry['size']
+			return self.ramp_color(entry['elevation']), width, height
+		if entry.get('encoding') == 'elevation':
+			image, width, height = self.topo_image(self.topo_filename(x, y, s))
+		else:
+			image, width, height = self.load_image(self.topo_filename(x, y, s)) # RGB tiles of older builds
+		return cairo.SurfacePattern(image), width, height
+	
+	def paint_region(self, ctx, lon, lat, scale, width, height, year):
+		"Paint map tiles covering `width` x `height` pixels of `ctx`. Pixel (0, 0) is at (lon, lat), `scale` is pixels per degree."
+		step = self.tile_step
+		lod = self.pixels_per_degree / scale
+		for xa in range(math.floor(lon / step) * step, math.ceil(lon + width / scale), step):
+			for ya in range(max(math.floor((lat - height / scale) / step) * step, -90), min(math.ceil(lat), 90), step):
+				image, w, h = self.map_tile(*self.tile_key(xa, ya, lod), year)
+				ctx.save()
+				ctx.translate((xa - lon) * scale, (lat - ya - step) * scale)
+				ctx.rectangle(0, 0, step * scale, step * scale)
+				ctx.clip()
+				ctx.scale(step * scale / w, step * scale / h)
+				ctx.set_source_surface(image)
+				ctx.paint()
+				ctx.restore()
+	
+	def contour_interval(self, s):
+		return min(self.contour_spacing * s, 2000)
+	
+	def contour_grid(self, x, y, s):
+		"Elevation at centers of cells of tile (x, y) at level of detail `s`, with one cell of the neighbouring tiles around. Cells average the model."
+		dem = self.dem
+		ppd = dem.pixels_per_degree
+		size = math.ceil(self.tile_step * self.pixels_per_degree / s)
+		edges = np.round(np.arange(-1, size + 2) * self.tile_step * ppd / size).astype(np.intp)
+		top = round((90 - y - self.tile_step) * ppd)
+		left = round((x + 180) * ppd)
+		rows = np.clip(top + np.arange(edges[0], edges[-1]), 0, dem.rows - 1)
+		cols = (left + np.arange(edges[0], edges[-1])) % dem.cols # wraps around the antimeridian
+		block = dem.array[np.ix_(rows, cols)].astype(np.float32)
+		cells = np.add.reduceat(np.add.reduceat(block, edges[:-1] - edges[0], axis=0), edges[:-1] - edges[0], axis=1)
+		counts = np.diff(edges).astype(np.float32)
+		return cells / np.outer(counts, counts)
+	
+	@surface
+	def tile_contours(self, x, y, s):
+		"Contour lines of tile (x, y) at level of detail `s`, and cairo paths of them in fractions of the tile: the shelf edge and the other levels."
+		contours = None
+		if self.disk_cache is not None:
+			key = self.disk_cache.key('contours', file_identity(self.dem_file), x, y, s, self.contour_interval(s))
+			cached = self.disk_cache.get(key, 'npz')
+			if cached is not None:
+				contours = TileContours.load(cached)
+		if contours is None:
+			z = self.contour_grid(x, y, s)
+			contours = TileContours.trace(z, levels_between(z.min(), z.max(), self.contour_interval(s)), z.shape[1] - 2)
+			if self.disk_cache is not None:
+				self.disk_cache.put(key, contours.save, 'npz')
+		
+		ctx = cairo.Context(cairo.RecordingSurface(cairo.Content.ALPHA, None))
+		paths = {}
+		for shelf in (False, True):
+			ctx.new_path()
+			for level, line in zip(contours.levels, contours.lines):
+				if (level == shelf_edge) == shelf:
+					ctx.move_to(*line[0])
+					for px, py in line[1:].tolist():
+						ctx.line_to(px, py)
+			paths['shelf' if shelf else 'levels'] = ctx.copy_path()
+		return contours, paths
+	
+	def preview_tile(self, x, y, s):
+		"Source pattern of the topo tile alone, without biome tint and blends, for drawing while the view moves."
+		self.require_tile(x, y, s)
+		return self.get_tile(x, y, s)
+	
+	def map_tile_key(self, x, y, s, year):
+		"Key of the composite returned by `map_tile` in `rendered_surface`."
+		return 'composite_tile', x, y, s, self.tile_epoch(x, y, year)
+	
+	def has_map_tile(self, x, y, s, year):
+		"Whether the composite is in memory, so that `map_tile` returns without rendering."
+		return self.map_tile_key(x, y, s, year) in self.rendered_surface
+	
+	def map_tile(self, x, y, s, year):
+		"Composite of tile (x, y) at level of detail `s` in the provided epoch."
+		self.require_tile(x, y, s)
+		return self.composite_tile(x, y, s, self.tile_epoch(x, y, year))
+	
+	def inverse_lut(self, projection, i, j, s):
+		"Lookup table of the projected tile in column `i` and row `j` (from the map origin, rows go south), cached for all epochs."
+		key = projection, i, j, s
+		try:
+			return self.inverse_luts[key]
+		except KeyError:
+			pass
+		step = self.tile_step
+		size = math.ceil(step * self.pixels_per_degree / s)
+		lut = self.inverse_luts[key] = InverseLUT(projections[projection], i * step, -j * step, step, size, size, step)
+		return lut
+	
+	@surface
+	def projected_tile(self, projection, i, j, s, year):
+		"Map tile of the projection, resampled from the composites at the same level of detail."
+		lut = self.inverse_lut(projection, i, j, s)
+		image = cairo.ImageSurface(cairo.Format.RGB24, lut.width, lut.height)
+		data = np.ndarray(shape=(lut.height, image.get_stride() // 4), dtype=np.uint32, buffer=image.get_data())
+		
+		def source(x, y):
+			tile, width, height = self.map_tile(x, y, s, year)
+			tile.flush()
+			return np.ndarray(shape=(height, tile.get_stride() // 4), dtype=np.uint32, buffer=tile.get_data())[:, :width]
+		
+		lut.resample(data[:, :lut.width], source)
+		image.mark_dirty()
+		return image, lut.width, lut.height
+	
+	def projected_tile_key(self, projection, i, j, s, year):
+		return 'projected_tile', projection, i, j, s, year
+	
+	def has_projected_tile(self, projection, i, j, s, year):
+		return self.projected_tile_key(projection, i, j, s, year) in self.rendered_surface
+	
+	@surface
+	def composite_tile(self, x, y, s, year):
+		"Topo tile (x, y) at level of detail `s`, tinted with the biome map of the provided year."
+		
+		if self.disk_cache is not None:
+			key = self.disk_cache.key('composite', self.topo_identity(x, y, s), self.biome_identity(year), s, year)
+			cached = self.load_cached_png(key)
+			if cached is not None:
+				return cached
+		
+		topo_pattern, width, height = self.get_tile(x, y, s)
+		
+		image = cairo.ImageSurface(cairo.Format.RGB24, width, height)
+		ctx = cairo.Context(image)
+		ctx.set_source_rgb(1, 1, 1)
+		ctx.paint()
+		
+		if self.biome_tiles is not None and year in self.biome_tiles.years:
+			self.paint_biome_tile(ctx, x, y, year, width, height)
+		else:
+			biome_image, biome_image_width, biome_image_height = self.load_biome(year)
+			ctx.save()
+			ctx.scale(width / self.tile_step, height / self.tile_step)
+			ctx.translate(-(x + 180), -(90 - y - self.tile_step))
+			ctx.scale(360 / biome_image_width, 180 / biome_image_height)
+			ctx.set_source_surface(biome_image)
+			ctx.rectangle(0, 0, biome_image_width, biome_image_height)
+			ctx.clip()
+			ctx.paint_with_alpha(0.5)
+			ctx.restore()
+		
+		ctx.push_group()
+		ctx.set_operator(cairo.Operator.OVER)
+		ctx.set_source_rgb(0, 1, 0)
+		ctx.paint()
+		ctx.set_operator(cairo.Operator.MULTIPLY)
+		ctx.set_source(topo_pattern)
+		ctx.paint()
+		ctx.set_operator(cairo.Operator.ADD)
+		ctx.set_source_rgb(0.25, 0.25, 0.25)
+		ctx.paint()
+		ctx.pop_group_to_source()
+		ctx.set_operator(cairo.Operator.HSL_LUMINOSITY)
+		ctx.paint()
+		image.flush()
+		
+		if self.disk_cache is not None:
+			self.store_cached_png(key, image)
+		return image, width, height
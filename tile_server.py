@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+Headless HTTP server of composited map tiles, for many browser clients at once.
+	
+	/metadata.json                                  tile geometry, levels of detail and available epochs
+	/grid/{lod}/{column}/{row}/{year_bp}.png        tile in `column` (from 180W eastwards) and `row` (from 90N southwards)
+
+This is not an XYZ (slippy map) endpoint: tiles are the fixed equirectangular grid of `tile_degrees` at every level of detail,
+`lod` only selects the resolution, from the coarsest one (0) to full resolution.
+"""
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from io import BytesIO
+from threading import Lock, Event
+
+from tile_cache import MemoryCache
+from tile_renderer import TileRenderer
+
+
+class TileService:
+	"Encoded tiles, shared by all requests. The same tile requested by several clients at once is rendered once."
+	
+	def __init__(self, renderer, memory_budget=256 * 1024**2):
+		self.renderer = renderer
+		self.encoded = MemoryCache(memory_budget)
+		self.pending = {}
+		self.lock = Lock()
+	
+	def metadata(self):
+		columns, rows = self.renderer.tile_grid()
+		return {
+			'tile_degrees': self.renderer.tile_step,
+			'columns': columns,
+			'rows': rows,
+			'levels': len(self.renderer.topo_levels),
+			'years': self.renderer.biome_years()
+		}
+	
+	def tile_png(self, lod, column, row, year_bp):
+		levels = self.renderer.topo_levels
+		columns, rows = self.renderer.tile_grid()
+		if not (0 <= lod < len(levels) and 0 <= column < columns and 0 <= row < rows):
+			raise KeyError((lod, column, row))
+		
+		s = levels[len(levels) - 1 - lod]
+		lon = -180 + column * self.renderer.tile_step
+		lat = 90 - (row + 1) * self.renderer.tile_step
+		year = self.renderer.tile_epoch(lon, lat, self.renderer.biome_epoch(year_bp))
+		key = lon, lat, s, year
+		
+		while True:
+			try:
+				return self.encoded[key]
+			except KeyError:
+				pass
+			
+			with self.lock:
+				try:
+					event = self.pending[key]
+					owner = False
+				except KeyError:
+					event = self.pending[key] = Event()
+					owner = True
+			
+			if not owner:
+				event.wait()
+				continue # rendered by other thread, or it failed and we try ourselves
+			
+			try:
+				image, width, height = self.renderer.map_tile(lon, lat, s, year)
+				buf = BytesIO()
+				image.write_to_png(buf)
+				data = buf.getvalue()
+				self.encoded[key] = data
+				return data
+			finally:
+				with self.lock:
+					del self.pending[key]
+				event.set()
+
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		service = self.server.service
+		path = self.path.split('?')[0].strip('/').split('/')
+		
+		try:
+			if path == ['metadata.json']:
+				self.reply(200, 'application/json', json.dumps(service.metadata()).encode('utf-8'))
+			elif len(path) == 5 and path[0] == 'grid' and path[4].endswith('.png'):
+				lod, column, row = (int(_n) for _n in path[1:4])
+				year_bp = int(path[4][:-4])
+				self.reply(200, 'image/png', service.tile_png(lod, column, row, year_bp), cache=True)
+			else:
+				self.send_error(404)
+		except (ValueError, KeyError, FileNotFoundError):
+			self.send_error(404)
+	
+	def reply(self, code, content_type, data, cache=False):
+		self.send_response(code)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(data)))
+		self.send_header('Access-Control-Allow-Origin', '*')
+		if cache:
+			self.send_header('Cache-Control', 'public, max-age=86400')
+		self.end_headers()
+		self.wfile.write(data)
+	
+	def log_message(self, format, *args):
+		pass
+
+
+class TileServer(HTTPServer):
+	"HTTP server handling requests on a fixed pool of threads. Cairo releases the GIL while compositing."
+	
+	def __init__(self, address, service, workers=8):
+		super().__init__(address, TileRequestHandler)
+		self.service = service
+		self.pool = ThreadPoolExecutor(max_workers=workers)
+	
+	def process_request(self, request, client_address):
+		self.pool.submit(self.process_request_thread, request, client_address)
+	
+	def process_request_thread(self, request, client_address):
+		try:
+			self.finish_request(request, client_address)
+		except Exception:
+			self.handle_error(request, client_address)
+		finally:
+			self.shutdown_request(request)
+	
+	def server_close(self):
+		super().server_close()
+		self.pool.shutdown(wait=False, cancel_futures=True) # queued requests do not delay exit
+
+
+def serve(host='127.0.0.1', port=8080, cache_dir=None, workers=8, color_ramp=('relief', 0)):
+	renderer = TileRenderer(cache_dir)
+	renderer.set_color_ramp(*color_ramp)
+	service = TileService(renderer)
+	server = TileServer((host, port), service, workers)
+	print(f"serving tiles on http://{host}:{port}/")
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		print()
+	finally:
+		server.server_close()
+
+
+if __name__ == '__main__':
+	import argparse
+	import os
+	
+	parser = argparse.ArgumentParser(description="Serve ChronoMaps tiles over HTTP.")
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=8080)
+	parser.add_argument('--workers', type=int, default=8)
+	parser.add_argument('--cache-dir', default=os.environ.get('CHRONOMAPS_CACHE', None))
+	parser.add_argument('--ramp', default='relief', help="colour ramp of the relief, see color_ramp.py")
+	parser.add_argument('--sea-level', type=float, default=0)
+	args = parser.parse_args()
+	
+	serve(args.host, args.port, args.cache_dir, args.workers, (args.ramp, args.sea_level))